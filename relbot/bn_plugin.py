@@ -1,48 +1,124 @@
 import itertools
 import random
+import re
+import time
+from typing import List
 
 import irc3
 from irc3.plugins.command import command
 
 from relbot.ircformat import Color, format_text
-from relbot.redflare_client import RedflareClient
+from relbot.outbound_queue import OutboundQueue, Priority
+from relbot.player_count_history import PlayerCountHistoryPlugin
+from relbot.redflare_diff import (
+    ALL_TRANSITIONS,
+    MAP_CHANGED,
+    MATCH_ENDED,
+    MATCH_STARTED,
+    PLAYERS_JOINED,
+    RedflareDiff,
+    ServerTransition,
+)
+from relbot.redflare_snapshot import RedflareSnapshot, RedflareSnapshotCache, RedflareUnavailableError
 from relbot.util import make_logger
 
 
 @irc3.plugin
 class RELBotBNPlugin:
+    # the commands and events of the shared plugins are only registered if their modules are included
+    # e.g., the snapshot cache refreshes the server list in the background once the bot has connected
+    requires = [
+        "relbot.outbound_queue",
+        "relbot.player_count_history",
+        "relbot.redflare_snapshot",
+    ]
+
     def __init__(self, bot):
         self.logger = make_logger(self.__class__.__name__)
 
         self.bot = bot
+        self.outbound: OutboundQueue = bot.get_plugin(OutboundQueue)
+        self.redflare: RedflareSnapshotCache = bot.get_plugin(RedflareSnapshotCache)
+        self.history: PlayerCountHistoryPlugin = bot.get_plugin(PlayerCountHistoryPlugin)
+
+        # announce matches starting and ending, players joining and leaving etc. in the configured channels
+        self.announce_channels = self._get_config_list("redflare_announce_channels")
+        self.announce_transitions = set(self._get_config_list("redflare_announce_transitions", "started"))
+        self.redflare_diff = RedflareDiff()
+
+        for transition in self.announce_transitions:
+            if transition not in ALL_TRANSITIONS:
+                raise ValueError("Unsupported Redflare transition: %s" % transition)
+
+        if self.announce_channels:
+            self.redflare.listeners["matches"] = self.announce_transitions_of
         self.redflare_url = self._relbot_config().get("redflare_url", None)
 
     def _relbot_config(self):
         return self.bot.config.get("relbot", dict())
 
-    @command(permission="view")
-    def matches(self, mask, target, args):
-        """List interesting Red Eclipse matches
+    def _get_config_list(self, config_key: str, default=""):
+        config_value = self._relbot_config().get(config_key, default)
 
-            %%matches
-        """
+        # irc3 turns values spanning multiple lines into lists
+        if isinstance(config_value, str):
+            return config_value.split()
+        elif isinstance(config_value, list):
+            return config_value
+        else:
+            raise ValueError("Unsupported value for %s: %r" % (config_key, config_value))
 
-        if not self.redflare_url:
-            yield "Redflare URL not configured"
-            return
+    @staticmethod
+    def _hide_nick(name: str) -> str:
+        # this is the "freem exception"
+        # freem doesnt like to be pinged on IRC whenever !matches is called while they are playing
+        # the easiest way to fix this is to just change the name in the listing
+        # ofc this only works until freem decides to use another nickname
+        if name == "freem":
+            return "_freem_"
+
+        return name
+
+    def _format_transition(self, transition: ServerTransition) -> str:
+        state = transition.state
+        players = ", ".join(sorted(self._hide_nick(p) for p in transition.players))
+        server = format_text(state.description, Color.ORANGE)
+        match = "%s on %s" % (format_text(state.game_mode, Color.GREY), format_text(state.map_name, Color.PINK))
+
+        if transition.kind == MATCH_STARTED:
+            return "Match started on %s: %s (%s)" % (server, match, players)
 
-        rfc = RedflareClient(self.redflare_url)
-        servers = rfc.servers()
+        if transition.kind == MATCH_ENDED:
+            return "Match ended on %s" % server
 
-        # i: Server
-        non_empty_legacy_servers = [s for s in servers if s.players_count > 0 and not s.version.startswith("2.")]
+        if transition.kind == MAP_CHANGED:
+            return "%s: now playing %s" % (server, match)
+
+        if transition.kind == PLAYERS_JOINED:
+            return "%s joined %s (%d players)" % (players, server, len(state.players))
+
+        return "%s left %s (%d players)" % (players, server, len(state.players))
+
+    def announce_transitions_of(self, snapshot: RedflareSnapshot):
+        for transition in self.redflare_diff.update(snapshot.servers):
+            if transition.kind not in self.announce_transitions:
+                continue
+
+            message = self._format_transition(transition)
+
+            for channel in self.announce_channels:
+                self.outbound.notice(channel, message, Priority.FEED)
+
+    def _render_matches(self, snapshot: RedflareSnapshot) -> List[str]:
+        non_empty_legacy_servers = snapshot.aggregate.busy_legacy_servers
 
         if not non_empty_legacy_servers:
-            yield "No legacy matches running at the moment."
-            return
+            return ["No legacy matches running at the moment."]
+
+        messages = []
 
         for server in sorted(non_empty_legacy_servers, key=lambda s: s.players_count, reverse=True):
-            players = [p.name for p in server.players]
+            players = [self._hide_nick(p.name) for p in server.players]
 
             # the colors we use to format player names
             colors = [Color.RED, Color.PINK, Color.GREEN, Color.LIGHT_GREEN, Color.ORANGE, None]
@@ -52,19 +128,11 @@ class RELBotBNPlugin:
             # it'd be nice to assign some sort of "persistent" colors derived from the nicks
             colors = itertools.cycle(colors)
 
-            # this is the "freem exception"
-            # freem doesnt like to be pinged on IRC whenever !matches is called while they are playing
-            # the easiest way to fix this is to just change the name in the listing
-            # ofc this only works until freem decides to use another nickname
-            players = ["_freem_" if p == "freem" else p for p in players]
-
             if server.time_left < 0:
                 time_remaining_str = "∞"
             else:
                 time_remaining_str = "%d:%d left" % (server.time_left // 60, server.time_left % 60)
 
-            print(server.players_count)
-
             message = "%s on %s (%s): %s %s on %s (%s)" % (
                 format_text(str(server.players_count), Color.RED),
                 format_text(server.description, Color.ORANGE),
@@ -75,32 +143,39 @@ class RELBotBNPlugin:
                 time_remaining_str,
             )
 
-            print(message)
-
-            self.logger.debug(repr(message))
+            messages.append(message)
 
-            yield message
+        return messages
 
     @command(permission="view")
-    def rivalry(self, mask, target, args):
-        """Show player counts on legacy and 2.x servers
+    async def matches(self, mask, target, args):
+        """List interesting Red Eclipse matches
 
-            %%rivalry
+            %%matches
         """
 
         if not self.redflare_url:
-            yield "Redflare URL not configured"
-            return
+            return "Redflare URL not configured"
 
-        rfc = RedflareClient(self.redflare_url)
-        servers = rfc.servers()
+        try:
+            snapshot = await self.redflare.get()
+        except RedflareUnavailableError:
+            return "Failed to fetch server list from Redflare"
 
-        # i: Server
-        non_legacy_servers = [s for s in servers if s.version.startswith("2.")]
-        legacy_servers = [s for s in servers if not s in non_legacy_servers]
+        # the messages only change when the server list does
+        messages = self.redflare.render("matches", snapshot, self._render_matches)
 
-        non_legacy_players_count = sum([s.players_count for s in non_legacy_servers])
-        legacy_players_count = sum([s.players_count for s in legacy_servers])
+        for message in messages[:-1]:
+            self.logger.debug(repr(message))
+            self.outbound.reply(mask, target, message)
+
+        # there might be quite a lot of replies, so they are sent through the outbound queue
+        self.outbound.reply(mask, target, "%s (%s)" % (messages[-1], snapshot.format_age()))
+
+    @staticmethod
+    def _render_rivalry(snapshot: RedflareSnapshot) -> str:
+        legacy_players_count = snapshot.aggregate.legacy_players_count
+        non_legacy_players_count = snapshot.aggregate.non_legacy_players_count
 
         message = "%d legacy vs. %d non-legacy players" % (legacy_players_count, non_legacy_players_count)
 
@@ -125,4 +200,63 @@ class RELBotBNPlugin:
         else:
             message += "... urgh..."
 
-        yield message
+        return message
+
+    def _rivalry_history(self, period: str) -> str:
+        match = re.fullmatch(r"([0-9]+)([mhd])", period)
+
+        if not match:
+            return "Invalid period: %s (examples: 30m, 24h, 7d)" % period
+
+        duration = int(match.group(1)) * {"m": 60, "h": 3600, "d": 86400}[match.group(2)]
+
+        history = self.history.history
+
+        if not 0 < duration <= history.legacy.max_duration:
+            return "Period must be between 1m and %dd" % (history.legacy.max_duration // 86400)
+
+        now = time.time()
+
+        legacy = history.legacy.summarize(now, duration)
+        non_legacy = history.non_legacy.summarize(now, duration)
+
+        if legacy is None or non_legacy is None:
+            return "No player counts recorded in the last %s" % period
+
+        message = "last %s: legacy %.1f avg, %d peak vs. non-legacy %.1f avg, %d peak" % (
+            period,
+            legacy.average,
+            legacy.peak,
+            non_legacy.average,
+            non_legacy.peak,
+        )
+
+        busiest = history.busiest_server(now, duration)
+
+        if busiest is not None:
+            description, summary = busiest
+            message += " -- busiest server: %s (%.1f avg, %d peak)" % (description, summary.average, summary.peak)
+
+        return message
+
+    @command(permission="view")
+    async def rivalry(self, mask, target, args):
+        """Show player counts on legacy and 2.x servers, optionally averages and peaks over a period (e.g., 24h, 7d)
+
+            %%rivalry [<period>]
+        """
+
+        if not self.redflare_url:
+            return "Redflare URL not configured"
+
+        if args["<period>"]:
+            return self._rivalry_history(args["<period>"])
+
+        try:
+            snapshot = await self.redflare.get()
+        except RedflareUnavailableError:
+            return "Failed to fetch server list from Redflare"
+
+        message = self.redflare.render("rivalry", snapshot, self._render_rivalry)
+
+        return "%s (%s)" % (message, snapshot.format_age())
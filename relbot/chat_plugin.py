@@ -1,3 +1,4 @@
+import asyncio
 import os
 import random
 import sys
@@ -8,17 +9,24 @@ import irc3
 from lxml import html
 
 from .jokes import JokesManager
+from .outbound_queue import OutboundQueue, Priority
 from .urbandictionary_client import UrbanDictionaryClient, UrbanDictionaryError
-from .util import managed_proxied_session, make_logger
+from .util import managed_proxied_session, make_logger, proxied_session_pool_stats
 from .wikipedia_client import WikipediaAPIError, WikipediaAPIClient
 
 
 @irc3.plugin
 class RELBotPlugin:
+    # the commands of the shared plugins are only registered if their modules are included
+    requires = [
+        "relbot.outbound_queue",
+    ]
+
     def __init__(self, bot):
         self.logger = make_logger(self.__class__.__name__)
 
         self.bot = bot
+        self.outbound: OutboundQueue = bot.get_plugin(OutboundQueue)
 
         try:
             self.jokes_manager = JokesManager(self._relbot_config()["jokes_file"])
@@ -41,6 +49,22 @@ class RELBotPlugin:
         doc = html.fromstring(response.text)
         yield doc.cssselect("h1.not")[0].text.strip()
 
+    @command(name="http-stats", permission="admin", show_in_help_list=False)
+    def http_stats(self, mask, target, args):
+        """Show how often connections to the hosts have been reused
+
+            %%http-stats
+        """
+
+        stats = proxied_session_pool_stats()
+
+        if not stats:
+            yield "No connections made so far"
+            return
+
+        for host, (new_connections, reused_connections) in sorted(stats.items()):
+            yield "%s: %d new, %d reused connections" % (host, new_connections, reused_connections)
+
     @command(name="reload-plugin", permission="admin")
     def reload_plugin(self, mask, target, args):
         """Reloads this plugin
@@ -100,7 +124,7 @@ class RELBotPlugin:
         yield "https://lmsptfy.com/?{}".format(querystring)
 
     @command(name="ud", permission="view")
-    def urbandictionary(self, mask, target, args):
+    async def urbandictionary(self, mask, target, args):
         """Search a term on urbandictionary.com
 
             %%ud <args>...
@@ -109,20 +133,23 @@ class RELBotPlugin:
         term = " ".join(args["<args>"])
 
         try:
-            definition = UrbanDictionaryClient.top_definition(term)
+            # the lookup is blocking, so it must not run in the event loop's thread
+            definition = await asyncio.to_thread(UrbanDictionaryClient.top_definition, term)
         except UrbanDictionaryError as e:
-            yield "error while fetching data from urbandictionary.com: %s" % str(e)
+            return "error while fetching data from urbandictionary.com: %s" % str(e)
         except:
-            yield "unknown error occured"
+            return "unknown error occured"
         else:
-            yield "%s: %s (example: %s)" % (definition.word, definition.meaning, definition.example)
+            # the notice must be sent after the reply, so both go through the outbound queue
+            message = "%s: %s (example: %s)" % (definition.word, definition.meaning, definition.example)
+            self.outbound.reply(mask, target, message)
 
             notice = "see %s for more definitions" % UrbanDictionaryClient.build_url(term)
-            self.bot.notice(target, notice)
+            self.outbound.notice(target, notice, Priority.INTERACTIVE)
 
 
     @command(name="wiki", permission="view")
-    def wikipedia_search(self, mask, target, args):
+    async def wikipedia_search(self, mask, target, args):
         """Search a term on en.wikipedia.org
 
             %%wiki <args>...
@@ -148,18 +175,20 @@ class RELBotPlugin:
         term = " ".join(args_args)
 
         try:
-            search_results = list(WikipediaAPIClient.search_for_term(term))
+            # the search is blocking, so it must not run in the event loop's thread
+            search_results = await asyncio.to_thread(lambda: list(WikipediaAPIClient.search_for_term(term)))
 
         except WikipediaAPIError as e:
-            yield "Wikipedia API error: %s" % str(e)
+            return "Wikipedia API error: %s" % str(e)
 
         except:
-            yield "unknown error occured"
+            return "unknown error occured"
 
         else:
             for page in search_results[:num_results]:
                 url = WikipediaAPIClient.get_page_url(page.title)
-                yield "%s: %s (%s)" % (page.title, page.snippet, url)
+                # there might be quite a lot of replies, so they are sent through the outbound queue
+                self.outbound.reply(mask, target, "%s: %s (%s)" % (page.title, page.snippet, url))
 
     @command(name="chuck", permission="view")
     def chuck(self, mask, target, args):
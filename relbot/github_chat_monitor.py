@@ -1,13 +1,27 @@
+import asyncio
 import re
+from collections import deque
+from typing import List, Dict, Union
 
 import irc3
-from lxml import html
 
-from relbot.github_issues_matcher import GitHubIssuesMatcher
-from relbot.util import managed_proxied_session, make_logger, format_github_event
+from relbot.github_issue_cache import GitHubIssueCache
+from relbot.github_issue_resolver import (
+    GitHubIssueScraper,
+    GitHubIssueResolverError,
+    GitHubIssueResolverBackend,
+    ResolvedGitHubIssue,
+    make_backend,
+)
+from relbot.github_issues_matcher import GitHubIssuesMatcher, GitHubIssue
+from relbot.outbound_queue import OutboundQueue, Priority
+from relbot.util import make_logger, format_github_event, AsyncSingleFlight
 
 logger = make_logger("github_integration")
 
+# what looks like one of these annoying Matrix IRC bridge reply messages
+MATRIX_REPLY_REGEX = re.compile(r'<[^"]+\s".*">\s(.*)')
+
 
 class GitHubChatMonitorError(Exception):
     def __init__(self, message):
@@ -17,100 +31,227 @@ class GitHubChatMonitorError(Exception):
         return self._message
 
 
-@irc3.event(irc3.rfc.PRIVMSG)
-def github_chat_monitor(bot, mask, target, data, **kwargs):
-    """
-    Check every message if it contains GitHub references (i.e., some #xyz number), and provide a link to GitHub
-    if possible.
-    Uses web scraping instead of any annoying
-    Note: cannot use yield to send replies; it'll fail silently then
-    """
+@irc3.plugin
+class GitHubChatMonitorPlugin:
+    # the commands of the shared plugins are only registered if their modules are included
+    requires = [
+        "relbot.outbound_queue",
+        "relbot.github_issue_cache",
+    ]
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        self.cache: GitHubIssueCache = bot.get_plugin(GitHubIssueCache)
+        self.outbound: OutboundQueue = bot.get_plugin(OutboundQueue)
+
+        # identical lookups running at the same time are coalesced
+        self.single_flight = AsyncSingleFlight()
+
+        config = self.bot.config.get("github_chat_monitor", dict())
+
+        # scraping the web pages is always available as a fallback for anything the configured backend cannot resolve
+        streaming = str(config.get("scraper_streaming", "true")).lower() in ["true", "yes", "1"]
+
+        self.scraper = GitHubIssueScraper(streaming)
+
+        # if the scraper is the configured backend, there is nothing to fall back to
+        self.backend: GitHubIssueResolverBackend = make_backend(
+            config.get("backend", "scraper"),
+            config.get("api_url", None),
+            config.get("github_token", None),
+            self.scraper,
+        )
+
+        # limits the amount of concurrent lookups, both per message and for the entire bot
+        self.max_lookups_per_message = int(config.get("max_concurrent_lookups_per_message", 4))
+        self.lookups_semaphore = asyncio.Semaphore(int(config.get("max_concurrent_lookups", 8)))
+
+        # replies are sent in the order in which the issues were mentioned
+        # however, if a lookup takes longer than this (in seconds), all other replies are sent as soon as they are ready
+        self.reply_order_timeout = float(config.get("reply_order_timeout", 3))
+
+        # the matcher only depends on the config, so it's built just once
+        self.matcher = self._make_matcher(config)
+
+    @staticmethod
+    def _make_matcher(config: dict) -> Union[GitHubIssuesMatcher, None]:
+        try:
+            default_organization = config["default_organization"]
+            default_repository = config["default_repository"]
+
+        except KeyError:
+            logger.error("default repo owner and/or name not configured")
+            return None
+
+        try:
+            aliases = config["aliases"]
+            parsed_aliases = {i: j for i, j in (i.split(":") for i in aliases)}
+
+        except (KeyError, TypeError):
+            parsed_aliases = {}
+
+        return GitHubIssuesMatcher(default_organization, default_repository, parsed_aliases)
+
+    @irc3.event(irc3.rfc.PRIVMSG)
+    def github_chat_monitor(self, mask, target, data, **kwargs):
+        """
+        Check every message if it contains GitHub references (i.e., some #xyz number), and provide a link to GitHub
+        if possible.
+        Uses web scraping instead of any annoying
+        Matching is done right away, whereas the lookups are run in the background, so the event loop is never blocked
+        by network I/O. Every reply is sent as soon as the corresponding lookup has finished.
+        Note: cannot use yield to send replies; it'll fail silently then
+        """
+
+        bot = self.bot
 
-    # do not react on notices
-    # this should prevent the bot from replying to other bots
-    if kwargs["event"].lower() != "privmsg":
-        logger.debug("ignoring %s event", kwargs["event"])
-        return
+        # do not react on notices
+        # this should prevent the bot from replying to other bots
+        if kwargs["event"].lower() != "privmsg":
+            logger.debug("ignoring %s event", kwargs["event"])
+            return
 
-    # also ignore quote part in what looks like one of these annoying Matrix IRC bridge reply messages
-    match = re.search(r'^<[^"]+\s".*">\s(.*)', data)
-    if match:
-        logger.debug("ignoring quoted part in potential Matrix IRC bridge reply")
-        data = match.group(1)
+        # also ignore quote part in what looks like one of these annoying Matrix IRC bridge reply messages
+        if data.startswith("<"):
+            match = MATRIX_REPLY_REGEX.match(data)
+            if match:
+                logger.debug("ignoring quoted part in potential Matrix IRC bridge reply")
+                data = match.group(1)
 
-    # skip all commands
-    if any((data.strip(" \r\n").startswith(i) for i in [bot.config["cmd"], bot.config["re_cmd"]])):
-        logger.warning("ignoring command: %s", data)
-        return
+        # skip all commands
+        if any((data.strip(" \r\n").startswith(i) for i in [bot.config["cmd"], bot.config["re_cmd"]])):
+            logger.warning("ignoring command: %s", data)
+            return
 
-    try:
-        github_chat_monitor_config = bot.config.get("github_chat_monitor", dict())
+        if self.matcher is None:
+            self.outbound.notice(target, "Error: default repo owner and/or name not configured", Priority.CHAT)
+            return
 
-        default_organization = github_chat_monitor_config["default_organization"]
-        default_repository = github_chat_monitor_config["default_repository"]
+        issues = self.matcher.find_all(data)
 
-    except KeyError:
-        bot.notice(target, "Error: default repo owner and/or name not configured")
-        return
+        if not issues:
+            return
 
-    except:
-        message = "Unknown error while parsing GitHub issues"
-        logger.exception(message)
-        bot.notice(target, message)
-        return
+        issues = self.matcher.deduplicate(issues)
+        logger.debug("deduplicated issues: %r", issues)
 
-    try:
-        aliases = github_chat_monitor_config["aliases"]
-        parsed_aliases = {i: j for i, j in (i.split(":") for i in aliases)}
+        if issues:
+            bot.create_task(self.resolve_and_notify(target, issues))
 
-    except (KeyError, TypeError):
-        parsed_aliases = {}
+    async def lookup(
+        self, backend: GitHubIssueResolverBackend, issues: List[GitHubIssue], message_semaphore: asyncio.Semaphore
+    ) -> Dict[str, ResolvedGitHubIssue]:
+        async with message_semaphore, self.lookups_semaphore:
+            # requests is synchronous, so we have to move the fetching and parsing to a worker thread
+            return await asyncio.to_thread(backend.resolve_many, issues)
 
-    resolver = GitHubIssuesMatcher(default_organization, default_repository, parsed_aliases)
+    async def lookup_batch(
+        self, issues: List[GitHubIssue], message_semaphore: asyncio.Semaphore
+    ) -> Dict[str, ResolvedGitHubIssue]:
+        try:
+            return await self.lookup(self.backend, issues, message_semaphore)
+
+        except:  # noqa
+            # all issues will be resolved by the fallback then
+            logger.exception("batch lookup of %d issues failed", len(issues))
+            return {}
+
+    async def lookup_issue(
+        self,
+        issue: GitHubIssue,
+        batch_lookup: Union[asyncio.Future, None],
+        message_semaphore: asyncio.Semaphore,
+    ) -> ResolvedGitHubIssue:
+        resolved = None
 
-    issues = resolver.find_github_issue_ids(data) + resolver.find_github_urls(data)
+        if batch_lookup is not None:
+            resolved = (await batch_lookup).get(issue.unique_id, None)
 
-    issues = resolver.deduplicate(issues)
-    logger.debug("deduplicated issues: %r", issues)
+        elif self.backend is not self.scraper:
+            try:
+                resolved = (await self.lookup(self.backend, [issue], message_semaphore)).get(issue.unique_id, None)
 
-    for repo_owner, repo_name, issue_id in issues:
-        # we just check the issues URL; GitHub should automatically redirect to pull requests
-        url = f"https://github.com/{repo_owner}/{repo_name}/issues/{issue_id}"
+            except GitHubIssueResolverError as e:
+                logger.warning("failed to resolve %s, falling back to scraper: %s", issue, e)
 
-        with managed_proxied_session() as session:
-            response = session.get(url, allow_redirects=True)
+        if resolved is None:
+            resolved = (await self.lookup(self.scraper, [issue], message_semaphore))[issue.unique_id]
 
-        if response.status_code != 200:
-            if response.status_code == 404:
-                # by providing a link, issues and PRs can still be accessed easily in case a repo is private
-                # if it just doesn't exist, users will see an error message on GitHub
-                message = (
-                    f"Could not find any information on {repo_owner}/{repo_name}#{issue_id} "
-                    f"(repository might be private, you can still try to open {url})"
-                )
-            else:
-                message = "Request to GitHub failed"
+        self.cache.put(resolved)
 
-            bot.notice(target, format_github_event(message))
+        return resolved
 
-            continue
+    @staticmethod
+    async def resolve(
+        issue: GitHubIssue, cached: Union[ResolvedGitHubIssue, None], lookup: Union[asyncio.Future, None]
+    ) -> str:
+        # recently resolved issues can be reported right away
+        if cached is not None:
+            logger.debug("cache hit for %s", issue)
+            return cached.format_notice()
 
-        tree = html.fromstring(response.content)
         try:
-            title = tree.cssselect("[data-testid=issue-header] bdi")[0].text.strip(" \r\n")
-        except IndexError:
-            title = tree.cssselect(".gh-header-title .js-issue-title")[0].text.strip(" \r\n")
-
-        url_parts = response.url.split("/")
-        if "pull" in url_parts:
-            type = "PR"
-        elif "issues" in url_parts:
-            type = "Issue"
-        elif "discussions" in url_parts:
-            type = "Discussion"
-        else:
-            type = "Unknown Entity"
-
-        notice = format_github_event("{} #{}: {} ({})".format(type, issue_id, title, response.url))
-
-        bot.notice(target, notice)
+            resolved = await lookup
+
+        except GitHubIssueResolverError as e:
+            logger.error("failed to resolve %s: %s", issue, e)
+            return format_github_event("Request to GitHub failed")
+
+        except:  # noqa
+            logger.exception("unknown error while resolving %s", issue)
+            return format_github_event("Request to GitHub failed")
+
+        return resolved.format_notice()
+
+    async def resolve_and_notify(self, target: str, issues: List[GitHubIssue]):
+        """
+        Resolve all issues concurrently, and send the replies in the order the issues were mentioned in.
+        """
+
+        message_semaphore = asyncio.Semaphore(self.max_lookups_per_message)
+
+        cached = [self.cache.get(issue) for issue in issues]
+        misses = [issue for issue, cached_issue in zip(issues, cached) if cached_issue is None]
+
+        # issues which are being looked up already (e.g., because they have been mentioned in another channel at the
+        # same time) share the running lookup
+        new_misses = [issue for issue in misses if not self.single_flight.in_flight(issue.unique_id)]
+
+        # batched backends can look up all the issues which are not in the cache with a single request
+        batch_lookup = None
+
+        if self.backend.batched and new_misses:
+            batch_lookup = asyncio.ensure_future(self.lookup_batch(new_misses, message_semaphore))
+
+        lookups = {
+            issue.unique_id: self.single_flight.do(
+                issue.unique_id, self.lookup_issue, issue, batch_lookup, message_semaphore
+            )
+            for issue in misses
+        }
+
+        pending = deque(
+            asyncio.ensure_future(self.resolve(issue, cached_issue, lookups.get(issue.unique_id, None)))
+            for issue, cached_issue in zip(issues, cached)
+        )
+
+        while pending:
+            try:
+                # the shield prevents the lookup from being cancelled on timeouts
+                notice = await asyncio.wait_for(asyncio.shield(pending[0]), self.reply_order_timeout)
+
+            except asyncio.TimeoutError:
+                logger.debug("lookup is taking too long, sending remaining replies as soon as they are ready")
+
+                for next_done in asyncio.as_completed(pending):
+                    self.outbound.notice(target, await next_done, Priority.CHAT)
+
+                return
+
+            pending.popleft()
+            self.outbound.notice(target, notice, Priority.CHAT)
+
+    @classmethod
+    def reload(cls, old):
+        return cls(old.bot)
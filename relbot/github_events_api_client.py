@@ -1,8 +1,12 @@
+import itertools
+import math
 import string
+import time
 from collections import namedtuple
-from typing import Iterator, List
+from email.utils import parsedate_to_datetime
+from typing import Dict, Generator, Iterable, Iterator, List, Tuple, Union
 
-from relbot.util import managed_proxied_session, make_logger
+from relbot.util import managed_session, make_logger
 
 
 class UnsupportedEventError(Exception):
@@ -10,11 +14,16 @@ class UnsupportedEventError(Exception):
     Thrown whenever an event type is not supported or the specific payload format is not understood.
     """
 
-    def __init__(self, event_type: str):
+    def __init__(self, event_type: str, action: str = None):
+        # this is raised for most events, so the message is only formatted when it is needed
         self.event_type = event_type
+        self.action = action
 
     def __str__(self):
-        return "Unsupported event: {}".format(self.event_type)
+        if self.action is None:
+            return "Unsupported event: {}".format(self.event_type)
+
+        return "Unsupported event: {} (action: {})".format(self.event_type, self.action)
 
 
 def format_user_name(name):
@@ -25,40 +34,36 @@ def format_id(name):
     return "#" + str(name)
 
 
-class GitHubEvent(namedtuple("GitHubEvent", ["id", "type", "actor", "repo", "date", "payload"])):
-    @classmethod
-    def from_json(cls, data: dict):
-        # we can only handle supported types
-        event_type = data["type"]
-
-        payload_class = None
+# maps event types to the classes which decode their payloads
+# plugins can add support for further event types with register_payload_class
+_PAYLOAD_CLASSES: Dict[str, type] = {}
 
-        if event_type == "PushEvent":
-            payload_class = PushEventPayload
 
-        elif event_type == "PullRequestEvent":
-            payload_class = PullRequestEventPayload
+def register_payload_class(event_type: str):
+    """
+    Class decorator which registers a payload class for the given event type. The class must provide a from_json
+    classmethod taking the payload and the repository data, which may raise UnsupportedEventError.
+    """
 
-        elif event_type == "CreateEvent":
-            payload_class = CreateEventPayload
+    def decorator(cls):
+        _PAYLOAD_CLASSES[event_type] = cls
+        return cls
 
-        elif event_type == "DeleteEvent":
-            payload_class = DeleteEventPayload
+    return decorator
 
-        elif event_type == "IssuesEvent":
-            payload_class = IssuesEventPayload
 
-        elif event_type == "IssueCommentEvent":
-            payload_class = IssueCommentEventPayload
+class GitHubEvent(namedtuple("GitHubEvent", ["id", "type", "actor", "repo", "date", "payload"])):
+    @classmethod
+    def from_json(cls, data: dict):
+        # we can only handle supported types
+        event_type = data["type"]
 
-        elif event_type == "ReleaseEvent":
-            payload_class = ReleaseEvent
+        try:
+            payload_class = _PAYLOAD_CLASSES[event_type]
 
-        if payload_class is None:
+        except KeyError:
             raise UnsupportedEventError(event_type)
 
-        payload = data["payload"]
-        
         # needed for create events
         repo = data.get("repo", None)
 
@@ -68,7 +73,7 @@ class GitHubEvent(namedtuple("GitHubEvent", ["id", "type", "actor", "repo", "dat
             format_user_name(data["actor"]["display_login"]),
             data["repo"]["name"],
             data["created_at"],
-            payload_class.from_json(payload, repo),
+            payload_class.from_json(data["payload"], repo),
         )
 
         return event
@@ -77,6 +82,7 @@ class GitHubEvent(namedtuple("GitHubEvent", ["id", "type", "actor", "repo", "dat
         return "[{}] {} {}".format(self.repo, self.actor, str(self.payload))
 
 
+@register_payload_class("PushEvent")
 class PushEventPayload(namedtuple("PushEventPayload", ["size", "ref"])):
     @classmethod
     def from_json(cls, data: dict, repo: dict):
@@ -86,6 +92,7 @@ class PushEventPayload(namedtuple("PushEventPayload", ["size", "ref"])):
         return "pushed {} commits to {}".format(self.size, self.ref)
 
 
+@register_payload_class("CreateEvent")
 class CreateEventPayload(namedtuple("CreateEventPayload", ["ref", "ref_type"])):
     @classmethod
     def from_json(cls, data: dict, repo: dict):
@@ -102,6 +109,7 @@ class CreateEventPayload(namedtuple("CreateEventPayload", ["ref", "ref_type"])):
         return "created {} {}".format(self.ref_type, self.ref)
 
 
+@register_payload_class("DeleteEvent")
 class DeleteEventPayload(namedtuple("DeleteEventPayload", ["ref", "ref_type"])):
     @classmethod
     def from_json(cls, data: dict, repo: dict):
@@ -111,6 +119,7 @@ class DeleteEventPayload(namedtuple("DeleteEventPayload", ["ref", "ref_type"])):
         return "deleted {} {}".format(self.ref_type, self.ref)
 
 
+@register_payload_class("IssuesEvent")
 class IssuesEventPayload(namedtuple("IssuesEventPayload", ["action", "number", "url", "title", "creator"])):
     SUPPORTED_ACTIONS = ["opened", "closed", "reopened"]
 
@@ -120,7 +129,7 @@ class IssuesEventPayload(namedtuple("IssuesEventPayload", ["action", "number", "
 
         # we can safely ignore assignment and labelling events
         if action not in cls.SUPPORTED_ACTIONS:
-            raise UnsupportedEventError()
+            raise UnsupportedEventError("IssuesEvent", action)
 
         issue = data["issue"]
 
@@ -145,11 +154,12 @@ class IssuesEventPayload(namedtuple("IssuesEventPayload", ["action", "number", "
         return fmt.format(**data)
 
 
+@register_payload_class("IssueCommentEvent")
 class IssueCommentEventPayload(namedtuple("IssueCommentEventPayload", ["number", "url", "title", "creator", "type"])):
     @classmethod
     def from_json(cls, data: dict, repo: dict):
         if data["action"] != "created":
-            raise UnsupportedEventError(data["action"])
+            raise UnsupportedEventError("IssueCommentEvent", data["action"])
 
         issue = data["issue"]
 
@@ -171,6 +181,7 @@ class IssueCommentEventPayload(namedtuple("IssueCommentEventPayload", ["number",
         return fmt.format(**self._asdict())
 
 
+@register_payload_class("ReleaseEvent")
 class ReleaseEvent(namedtuple("ReleaseEvent", ["action", "release_name", "repo_name", "creator", "url", "prerelease"])):
     @classmethod
     def from_json(cls, data: dict, repo: dict):
@@ -196,6 +207,7 @@ class ReleaseEvent(namedtuple("ReleaseEvent", ["action", "release_name", "repo_n
         return fmt.format(type=type_, **self._asdict())
 
 
+@register_payload_class("PullRequestEvent")
 class PullRequestEventPayload(namedtuple("PullRequestEventPayload", ["action", "number", "url", "title", "creator", "merged", "merged_by"])):
     SUPPORTED_EVENTS = ["opened", "closed", "reopened"]
 
@@ -206,7 +218,7 @@ class PullRequestEventPayload(namedtuple("PullRequestEventPayload", ["action", "
         action = data["action"]
 
         if action not in cls.SUPPORTED_EVENTS:
-            raise UnsupportedEventError()
+            raise UnsupportedEventError("PullRequestEvent", action)
 
         try:
             merged_by = format_user_name(pr["merged_by"]["login"])
@@ -244,15 +256,81 @@ class PullRequestEventPayload(namedtuple("PullRequestEventPayload", ["action", "
         return fmt.format(**data)
 
 
+class CachedEventsPage:
+    """
+    Everything we need to remember about the first page of events: the validators to make conditional requests, and
+    the parsed entries. Unlike the response, this does not keep the raw body or the connection alive, and answering
+    a 304 response from it does not require any parsing. The entries are only decoded as far as needed, typically
+    only the few newer than the checkpoint, and are dropped once they have been reported.
+    """
+
+    __slots__ = ("etag", "last_modified", "newest_id", "oldest_id", "entries", "next_url")
+
+    def __init__(
+        self,
+        etag: Union[str, None],
+        last_modified: Union[str, None],
+        newest_id: Union[int, None] = None,
+        oldest_id: Union[int, None] = None,
+        entries: Tuple[dict, ...] = (),
+        next_url: Union[str, None] = None,
+    ):
+        self.etag = etag
+        self.last_modified = last_modified
+
+        # IDs of the newest and oldest events on the page, including unsupported ones
+        # both are None if the page was empty, or if only the validators were restored from a previous run
+        self.newest_id = newest_id
+        self.oldest_id = oldest_id
+
+        self.entries = entries
+        self.next_url = next_url
+
+
+def align_poll_time(t: float, phase: float, period: float) -> float:
+    """
+    Round a point in time up to the next one in the given phase, i.e., phase + k * period. When every client polls
+    in a phase of its own, the clients never poll at the same time, no matter how their delays change.
+    """
+
+    # tolerate rounding errors, a poll scheduled right on time must not be postponed by an entire period
+    k = math.ceil((t - phase) / period - 1e-6)
+
+    return phase + k * period
+
+
 class GithubEventsAPIClient:
-    def __init__(self, organization: str):
+    # GitHub asks clients not to poll more often than this unless the X-Poll-Interval header says otherwise
+    DEFAULT_POLL_INTERVAL = 60
+
+    def __init__(self, source: str, max_poll_interval: float = 600, per_page: int = 30, api_url: str = None):
+        """
+        :param source: either an organization (e.g., blue-nebula) or a repository (e.g., blue-nebula/base)
+        :param per_page: number of events per page (GitHub allows up to 100)
+        :param api_url: base URL of the API, can be changed, e.g., to use a local test server
+        """
+
         self.logger = make_logger("GitHubEventsAPIClient")
 
-        # sanity check to make handling the organization name a little easier
-        for c in organization:
-            assert c in (string.ascii_letters + string.digits + "-_")
+        # sanity check to make handling the organization and repository names a little easier
+        for c in source:
+            assert c in (string.ascii_letters + string.digits + "-_./")
+
+        assert source.count("/") <= 1, "invalid source: %s" % source
+
+        self.source = source
 
-        self.organization = organization
+        if api_url is None:
+            api_url = "https://api.github.com"
+
+        self.api_url = api_url.rstrip("/")
+
+        if "/" in source:
+            self.url = "%s/repos/%s/events" % (self.api_url, source)
+        else:
+            self.url = "%s/orgs/%s/events" % (self.api_url, source)
+
+        self.url += "?per_page=%d" % per_page
 
         # while the bot is running, we need to remember which messages we've reported already
         # therefore we store the ID of the last reported event
@@ -260,119 +338,409 @@ class GithubEventsAPIClient:
         # while set to <0, nothing should be reported
         self.last_reported_id = -1
 
-        # we store the last response
+        # we store the first page of the last response
         # the client can use it to check whether anything has changed, and if this is not the case return the cached
         # data
-        self.cached_response = None
+        self.cached_page: Union[CachedEventsPage, None] = None
 
-    def fetch_events(self) -> List[GitHubEvent]:
-        url = "https://api.github.com/orgs/%s/events" % self.organization
+        # polling is adapted to what GitHub tells us in the response headers
+        # we poll as often as we are allowed to while there is activity, and back off while the feed is idle
+        self.poll_interval = self.DEFAULT_POLL_INTERVAL
+        self.max_poll_interval = max_poll_interval
+        self.idle_polls = 0
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
 
-        with managed_proxied_session() as session:
-            headers = {}
+        # point in time until which GitHub asked us not to send any further requests (secondary rate limits)
+        self.retry_after = None
 
-            # we use the last-modified header of the cached response to avoid running into API rate limits
-            # that way, we save responses as long as nothing has changed, as GitHub will return a 304 response
-            # this way, we can poll somewhat safely every minute
-            if self.cached_response:
-                for header in ["last-modified", "retry-after", "date"]:
-                    try:
-                        headers["if-modified-since"] = self.cached_response.headers[header]
+    def _update_polling_parameters(self, headers):
+        try:
+            self.poll_interval = int(headers["X-Poll-Interval"])
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            self.rate_limit_remaining = int(headers["X-RateLimit-Remaining"])
+            self.rate_limit_reset = int(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            pass
+
+    def _update_retry_after(self, headers):
+        # the header contains either a number of seconds or an HTTP date
+        try:
+            value = headers["Retry-After"]
+        except KeyError:
+            return
+
+        try:
+            self.retry_after = time.time() + int(value)
+        except ValueError:
+            try:
+                self.retry_after = parsedate_to_datetime(value).timestamp()
+            except (TypeError, ValueError):
+                self.logger.warning("%s: invalid Retry-After header: %s", self.source, value)
+
+    def next_poll_delay(self, active_clients: int = 1) -> float:
+        """
+        Calculate how long to wait until the next poll (in seconds).
+        :param active_clients: number of clients polling at the same time, which share the rate limit of the same
+            token or IP address
+        """
+
+        # exponential backoff while nothing happens
+        delay = min(self.poll_interval * 2 ** self.idle_polls, max(self.max_poll_interval, self.poll_interval))
 
-                    except KeyError:
-                        self.logger.warning("cached response did not contain header %s, trying next", header)
+        # spread the remaining requests evenly over the time until the rate limit is reset
+        # every client only gets its share of them
+        if self.rate_limit_remaining is not None and self.rate_limit_reset is not None:
+            time_until_reset = max(0.0, self.rate_limit_reset - time.time())
 
-                    else:
-                        break
+            if self.rate_limit_remaining <= 0:
+                delay = max(delay, time_until_reset)
+            else:
+                delay = max(delay, time_until_reset * max(1, active_clients) / self.rate_limit_remaining)
 
-                else:
-                    self.logger.error(
-                        "cached response did contain any header we could use for if-modified-since, "
-                        "will likely run into rate limit"
-                    )
+        if self.retry_after is not None:
+            delay = max(delay, self.retry_after - time.time())
 
+        return delay
+
+    def _get(self, url: str, headers: Dict[str, str] = None):
+        with managed_session(self.api_url) as session:
             response = session.get(url, allow_redirects=True, headers=headers)
 
-        response.raise_for_status()
+        # 304 responses contain these headers as well, and so do the error responses sent when we hit the rate limit
+        self._update_polling_parameters(response.headers)
 
-        if response.status_code == 304:
-            self.logger.info("using cached response")
-            response = self.cached_response
+        if response.status_code in (403, 429):
+            self._update_retry_after(response.headers)
 
-        elif response.status_code == 200:
-            self.cached_response = response
+        self.logger.info(
+            "%s: GitHub API limit: %s/%s, poll interval: %s",
+            self.source,
+            response.headers.get("X-RateLimit-Remaining", None),
+            response.headers.get("X-RateLimit-Limit", None),
+            response.headers.get("X-Poll-Interval", None),
+        )
 
-        else:
+        response.raise_for_status()
+
+        if response.status_code not in (200, 304):
             raise ValueError("invalid response status code %d" % response.status_code)
 
-        self.logger.info(
-            "GitHub API limit: %s/%s",
-            response.headers["X-RateLimit-Remaining"],
-            response.headers["X-RateLimit-Limit"]
+        return response
+
+    @staticmethod
+    def _parse_entries(response) -> List[dict]:
+        entries = response.json()
+
+        # make sure the events are sorted in a descending order (this is how GitHub returns them by default)
+        entries.sort(key=lambda i: int(i["id"]), reverse=True)
+
+        return entries
+
+    def _fetch_first_page(self) -> CachedEventsPage:
+        """
+        Fetch the first page of events conditionally. The result is cached until the page changes.
+        """
+
+        headers = {}
+
+        # we send the validators of the cached page to avoid running into API rate limits
+        # that way, we save responses as long as nothing has changed, as GitHub will return a 304 response, which
+        # does not count against the rate limit
+        if self.cached_page is not None:
+            if self.cached_page.etag:
+                headers["if-none-match"] = self.cached_page.etag
+
+            if self.cached_page.last_modified:
+                headers["if-modified-since"] = self.cached_page.last_modified
+
+        if self.last_reported_id >= 0 and not headers:
+            self.logger.warning("no validators available, will likely run into rate limit")
+
+        response = self._get(self.url, headers)
+
+        # we only send validators if there is a cached page
+        # in case the validators were restored from a previous run, the page does not contain any events
+        # however, they were saved along with the last reported event, so there cannot be any new events
+        if response.status_code == 304:
+            self.logger.info("using cached page")
+            return self.cached_page
+
+        entries = self._parse_entries(response)
+
+        try:
+            newest_id, oldest_id = int(entries[0]["id"]), int(entries[-1]["id"])
+        except IndexError:
+            newest_id, oldest_id = None, None
+
+        self.cached_page = CachedEventsPage(
+            response.headers.get("etag", None),
+            response.headers.get("last-modified", None),
+            newest_id,
+            oldest_id,
+            tuple(entries),
+            response.links.get("next", {}).get("url", None),
         )
 
-        data = response.json()
+        return self.cached_page
 
-        events = []
+    def _fetch_page(self, url: str) -> Tuple[List[dict], Union[str, None]]:
+        """
+        Fetch one of the following pages of events. Those are neither cached nor decoded, as they are only needed to
+        catch up after bursts of events, and most of the events on them have typically been reported already.
+        :return: raw events on the page (newest first), URL of the next page (if any)
+        """
 
-        for entry in data:
-            try:
-                event = GitHubEvent.from_json(entry)
+        response = self._get(url)
 
-            # we just ignore all events we don't understand
-            except UnsupportedEventError as e:
-                self.logger.debug(str(e))
-                continue
+        return self._parse_entries(response), response.links.get("next", {}).get("url", None)
 
-            except:  # noqa
-                self.logger.exception("Failed to parse event (unknown error), skipping")
+    def _decode_event(self, entry: dict) -> Union[GitHubEvent, None]:
+        try:
+            return GitHubEvent.from_json(entry)
 
-            else:
-                events.append(event)
+        # we just ignore all events we don't understand
+        except UnsupportedEventError as e:
+            self.logger.debug("%s", e)
 
-        # make sure the events are sorted in a descending order (this is how GitHub returns them by default)
-        events.sort(key=lambda i: i.id, reverse=True)
+        except:  # noqa
+            self.logger.exception("Failed to parse event (unknown error), skipping")
+
+        return None
+
+    def _decode_events(self, entries: Iterable[dict]) -> Iterator[GitHubEvent]:
+        for entry in entries:
+            event = self._decode_event(entry)
+
+            if event is not None:
+                yield event
+
+    def _iter_entries(self, url: Union[str, None]) -> Iterator[dict]:
+        """
+        Iterate over the raw events on the given page and all following ones, newest first. Further pages are only
+        fetched once the events on the previous page have been consumed.
+        """
+
+        while url is not None:
+            entries, url = self._fetch_page(url)
+            yield from entries
+
+    def fetch_events(self) -> List[GitHubEvent]:
+        """
+        Fetch the first page of events. The entries are dropped from the cache once fetch_new_events has reported
+        them, so clients which are used for polling return no events here until the page changes.
+        """
 
-        # sanity check (of course, this only works with 2+ events)
-        if len(events) > 2:
-            assert events[0].id > events[1].id
+        return list(self._decode_events(self._fetch_first_page().entries))
 
-        return events
+    def iter_events(self) -> Iterator[GitHubEvent]:
+        """
+        Iterate over all events GitHub provides, newest first. Further pages are only fetched once the events on the
+        previous page have been consumed.
+        """
+
+        page = self._fetch_first_page()
 
-    def setup(self):
+        yield from self._decode_events(itertools.chain(page.entries, self._iter_entries(page.next_url)))
+
+    def setup(self) -> List[GitHubEvent]:
         """
         Calls GitHub API once initially. The instance remembers which messages were existing at this point, and will
         return only events newer than that.
+        :return: events which were existing at this point
         """
 
-        events = self.fetch_events()
+        page = self._fetch_first_page()
 
         # make sure fetch_new_events ignores all events which happened up to this point
-        try:
-            initial_event = events[0]
-            self.last_reported_id = int(initial_event.id)
-
-        except IndexError:
+        # unsupported events count as well, there is no need to look at them again
+        if page.newest_id is not None:
+            self.last_reported_id = page.newest_id
+        else:
             self.last_reported_id = 0
 
+        return list(self._decode_events(page.entries))
+
+    def get_state(self) -> dict:
+        """
+        State which needs to be persisted to continue where we left off after a restart.
+        """
+
+        etag, last_modified = None, None
+
+        if self.cached_page is not None:
+            etag, last_modified = self.cached_page.etag, self.cached_page.last_modified
+
+        return {
+            "last_reported_id": self.last_reported_id,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
+    def restore_state(self, state: dict):
+        self.last_reported_id = int(state["last_reported_id"])
+
+        etag, last_modified = state.get("etag", None), state.get("last_modified", None)
+
+        # the events are not stored, we only need the validators to find out whether anything has happened meanwhile
+        if etag or last_modified:
+            self.cached_page = CachedEventsPage(etag, last_modified)
+
     def fetch_new_events(self) -> Iterator[GitHubEvent]:
+        """
+        Iterate over all events newer than the last reported one, newest first. Follows the pagination as far as
+        necessary, so bursts of events larger than a single page are not lost.
+        The checkpoint is updated once all new events have been consumed.
+        """
+
         assert int(self.last_reported_id) >= 0, "events have never been checked before -- forgot to call setup()?"
 
-        # we need to make sure all entries are sorted properly
-        events = self.fetch_events()
+        last_reported_id = int(self.last_reported_id)
+
+        page = self._fetch_first_page()
+
+        # this is by far the most common case, and can be answered without looking at any events
+        if page.newest_id is None or page.newest_id <= last_reported_id:
+            # the backoff is capped by max_poll_interval anyway
+            self.idle_polls = min(self.idle_polls + 1, 16)
+            page.entries = ()
+            return
+
+        # the following pages are only fetched if the burst of new events is larger than the first page
+        reached_checkpoint = yield from self._decode_new_events(
+            itertools.chain(page.entries, self._iter_entries(page.next_url)), last_reported_id
+        )
+
+        # GitHub only provides a limited amount of events
+        if not reached_checkpoint and last_reported_id > 0:
+            self.logger.warning("%s: could not find last reported event, some events might have been lost", self.source)
+
+        self.last_reported_id = page.newest_id
+        self.idle_polls = 0
+
+        # all entries have been reported, only the validators and IDs are needed to answer the following polls
+        page.entries = ()
+
+    def _decode_new_events(self, entries: Iterable[dict], last_reported_id: int) -> Generator[GitHubEvent, None, bool]:
+        """
+        Decode the raw events newer than the given checkpoint.
+        :return: whether the checkpoint has been reached
+        """
+
+        # smallest ID seen so far
+        # when new events arrive while we are paginating, older entries shift onto the following pages, and we must
+        # not report them twice
+        smallest_id = None
+
+        for entry in entries:
+            entry_id = int(entry["id"])
+
+            # the ID is cheap to read, so we can stop at the checkpoint before decoding any payloads
+            if entry_id <= last_reported_id:
+                return True
+
+            if smallest_id is not None and entry_id >= smallest_id:
+                continue
+
+            smallest_id = entry_id
+
+            event = self._decode_event(entry)
 
-        for event in events:
-            if int(event.id) <= int(self.last_reported_id):
-                break
+            if event is not None:
+                yield event
 
-            yield event
+        return False
 
-        # events might be an empty list
-        if events:
-            self.last_reported_id = int(events[0].id)
+
+def _benchmark(paths: List[str]):
+    """
+    Compare eagerly decoding entire pages with the lazy decoding used while polling, where usually only a few events
+    are newer than the checkpoint.
+    :param paths: recorded pages of events (JSON files as returned by the API), newest page first
+    """
+
+    import json
+    import timeit
+
+    pages = []
+
+    for path in paths:
+        with open(path) as f:
+            pages.append(json.load(f))
+
+    if not pages:
+        # a synthetic page resembling a typical organization feed
+        pages.append(
+            [
+                {
+                    "id": str(1000 - i),
+                    "type": ["PushEvent", "WatchEvent", "IssueCommentEvent", "PullRequestEvent"][i % 4],
+                    "actor": {"display_login": "user%d" % i},
+                    "repo": {"name": "blue-nebula/base"},
+                    "created_at": "2021-01-01T00:00:00Z",
+                    "payload": {
+                        "size": 1,
+                        "ref": "refs/heads/master",
+                        "action": ["created", "opened"][i % 2],
+                        "number": i,
+                        "issue": {"number": i, "html_url": "", "title": "title", "user": {"login": "user"}},
+                        "pull_request": {
+                            "html_url": "",
+                            "title": "title",
+                            "user": {"login": "user"},
+                            "merged": False,
+                            "merged_by": None,
+                        },
+                    },
+                }
+                for i in range(30)
+            ]
+        )
+
+    entries = [entry for page in pages for entry in page]
+    entries.sort(key=lambda i: int(i["id"]), reverse=True)
+
+    benchmark_client = GithubEventsAPIClient("blue-nebula")
+
+    def eager():
+        events = []
+
+        for entry in entries:
+            try:
+                events.append(GitHubEvent.from_json(entry))
+            except UnsupportedEventError as e:
+                benchmark_client.logger.debug(str(e))
+
+        return [e for e in events if e.id > checkpoint]
+
+    def lazy():
+        return list(benchmark_client._decode_new_events(entries, checkpoint))
+
+    iterations = 2000
+
+    for new_events_count in [0, 1, 5]:
+        checkpoint = int(entries[min(new_events_count, len(entries) - 1)]["id"])
+
+        eager_duration = timeit.timeit(eager, number=iterations) / iterations
+        lazy_duration = timeit.timeit(lazy, number=iterations) / iterations
+
+        print(
+            "%d events, %d new: eager %.1f µs, lazy %.1f µs per page"
+            % (len(entries), new_events_count, eager_duration * 1e6, lazy_duration * 1e6)
+        )
 
 
 if __name__ == "__main__":
+    import sys
+
+    # benchmark: python -m relbot.github_events_api_client --benchmark [recorded pages...]
+    if sys.argv[1:2] == ["--benchmark"]:
+        _benchmark(sys.argv[2:])
+        sys.exit(0)
+
     client = GithubEventsAPIClient("blue-nebula")
 
     # for debugging we print all events we can possibly get
@@ -0,0 +1,181 @@
+from collections import OrderedDict, deque
+from typing import Callable, Deque, Dict, Iterable, List, Tuple, Union
+
+from relbot.github_events_api_client import GitHubEvent
+from relbot.util import format_github_event
+
+
+def format_actors(actors: Iterable[str]) -> str:
+    return ", ".join(OrderedDict.fromkeys(actors))
+
+
+def format_numbers(numbers: Iterable[str]) -> str:
+    """
+    Format issue or pull request numbers compactly, e.g., #1..#4, #7, #9..#10.
+    """
+
+    values = sorted({int(n.lstrip("#")) for n in numbers})
+
+    ranges: List[List[int]] = []
+
+    for value in values:
+        if ranges and ranges[-1][1] == value - 1:
+            ranges[-1][1] = value
+        else:
+            ranges.append([value, value])
+
+    return ", ".join("#%d" % start if start == end else "#%d..#%d" % (start, end) for start, end in ranges)
+
+
+def _summarize_pushes(events: List[GitHubEvent]) -> str:
+    commits = sum(e.payload.size for e in events)
+    return "pushed {} commits in {} pushes to {}".format(commits, len(events), events[0].payload.ref)
+
+
+def _summarize_pull_requests(events: List[GitHubEvent]) -> str:
+    payload = events[0].payload
+    numbers = format_numbers(e.payload.number for e in events)
+
+    if payload.action == "closed":
+        if payload.merged:
+            return "merged {} pull requests: {}".format(len(events), numbers)
+
+        return "closed {} pull requests without merging them: {}".format(len(events), numbers)
+
+    return "{} {} pull requests: {}".format(payload.action, len(events), numbers)
+
+
+def _summarize_issues(events: List[GitHubEvent]) -> str:
+    numbers = format_numbers(e.payload.number for e in events)
+    return "{} {} issues: {}".format(events[0].payload.action, len(events), numbers)
+
+
+def _summarize_comments(events: List[GitHubEvent]) -> str:
+    # the title might have changed in the meantime
+    payload = events[-1].payload
+    return "commented {} times on {} {}: {} (opened by {}, {})".format(
+        len(events), payload.type, payload.number, payload.title, payload.creator, payload.url
+    )
+
+
+def _summarize_refs(verb: str) -> Callable[[List[GitHubEvent]], str]:
+    def summarize(events: List[GitHubEvent]) -> str:
+        refs = ", ".join(OrderedDict.fromkeys(e.payload.ref for e in events))
+        return "{} {} {}s: {}".format(verb, len(events), events[0].payload.ref_type, refs)
+
+    return summarize
+
+
+# event type -> (function returning which events of the same type can be merged, function summarizing them)
+# all other events (e.g., releases) are always reported individually
+_COALESCERS: Dict[str, Tuple[Callable, Callable[[List[GitHubEvent]], str]]] = {
+    "PushEvent": (lambda p: p.ref, _summarize_pushes),
+    "PullRequestEvent": (lambda p: (p.action, p.merged), _summarize_pull_requests),
+    "IssuesEvent": (lambda p: p.action, _summarize_issues),
+    "IssueCommentEvent": (lambda p: p.number, _summarize_comments),
+    "CreateEvent": (lambda p: p.ref_type, _summarize_refs("created")),
+    "DeleteEvent": (lambda p: p.ref_type, _summarize_refs("deleted")),
+}
+
+
+class GitHubEventsDigest:
+    """
+    Aggregation stage between the events feed and the channels.
+    Events are collected for a while, then related events (e.g., multiple pushes to the same branch) are merged into a
+    single line. To prevent floods, only a limited number of lines is returned per call of pop_lines, the remaining
+    lines are kept for the next call.
+    Events are counted in the order they are added, so callers can find out when certain events have been reported
+    completely: once reported_count has reached the value added_count had right after adding them.
+    """
+
+    def __init__(self, max_lines: int):
+        # <= 0 means unlimited
+        self.max_lines = max_lines
+
+        self.added_count = 0
+        self.reported_count = 0
+
+        self._events: List[GitHubEvent] = []
+        # lines, along with the number of events which have been reported completely once the line has been popped
+        self._lines: Deque[Tuple[str, Union[int, None]]] = deque()
+
+    def add(self, events: Iterable[GitHubEvent]):
+        """
+        :param events: events in chronological order (i.e., oldest first)
+        """
+
+        events = list(events)
+
+        self._events.extend(events)
+        self.added_count += len(events)
+
+    @staticmethod
+    def coalesce(events: Iterable[GitHubEvent]) -> List[str]:
+        """
+        Merge related events. Every group is reported at the position of its first event.
+        :param events: events in chronological order (i.e., oldest first)
+        :return: notices
+        """
+
+        groups: Dict[tuple, List[GitHubEvent]] = OrderedDict()
+
+        for event in events:
+            try:
+                make_key, _ = _COALESCERS[event.type]
+
+            except KeyError:
+                # use a key which cannot collide with any other
+                key = (id(event),)
+
+            else:
+                key = (event.repo, event.type, make_key(event.payload))
+
+            groups.setdefault(key, []).append(event)
+
+        lines = []
+
+        for group in groups.values():
+            if len(group) == 1:
+                lines.append(format_github_event(group[0]))
+                continue
+
+            _, summarize = _COALESCERS[group[0].type]
+            actors = format_actors(e.actor for e in group)
+
+            lines.append(format_github_event("[{}] {} {}".format(group[0].repo, actors, summarize(group))))
+
+        return lines
+
+    def pop_lines(self) -> List[str]:
+        """
+        Merge the events collected so far, and return as many lines as the budget allows.
+        """
+
+        lines = self.coalesce(self._events)
+        self._events = []
+
+        # the lines of a group are reported at the position of the group's first event, so the events merged so far
+        # are only reported completely once the last of their lines has been popped
+        if lines:
+            self._lines.extend((line, None) for line in lines[:-1])
+            self._lines.append((lines[-1], self.added_count))
+
+        if self.max_lines <= 0:
+            count = len(self._lines)
+        else:
+            count = min(self.max_lines, len(self._lines))
+
+        popped = []
+
+        for _ in range(count):
+            line, reported_count = self._lines.popleft()
+
+            if reported_count is not None:
+                self.reported_count = reported_count
+
+            popped.append(line)
+
+        return popped
+
+    def __len__(self):
+        return len(self._events) + len(self._lines)
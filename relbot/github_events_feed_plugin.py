@@ -1,38 +1,118 @@
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Tuple, Union
+
 import irc3
 import requests
 from irc3.plugins.command import command
-from irc3.plugins.cron import cron
 
-from relbot.github_events_api_client import GithubEventsAPIClient
+from relbot.github_events_api_client import GithubEventsAPIClient, GitHubEvent, align_poll_time
+from relbot.github_events_digest import GitHubEventsDigest
+from relbot.github_events_router import GitHubEventsRouter
+from relbot.github_events_state import GitHubEventsStateStore
+from relbot.github_issue_cache import GitHubIssueCache
+from relbot.github_webhook_server import GitHubWebhookServer
+from relbot.outbound_queue import OutboundQueue, Priority
 from relbot.util import format_github_event, make_logger
 
 
 @irc3.plugin
 class RELBotGitHubEventsFeedPlugin:
+    # the commands of the shared plugins are only registered if their modules are included
+    requires = [
+        "relbot.outbound_queue",
+        "relbot.github_issue_cache",
+    ]
+
     def __init__(self, bot):
         self.logger = make_logger(self.__class__.__name__)
 
         self.bot = bot
+        self.outbound: OutboundQueue = bot.get_plugin(OutboundQueue)
+        self.issue_cache: GitHubIssueCache = bot.get_plugin(GitHubIssueCache)
 
-        events_channels = self._get_github_events_channels()
+        # the channel configuration is compiled once, so routing events is cheap
+        self.router = GitHubEventsRouter(
+            self._get_config_lines("github_events_routes"), self._get_github_events_channels()
+        )
+        events_channels = self.router.channels
+
+        # all GitHub organizations and repositories we report events for
+        self.github_events_api_clients: Dict[str, GithubEventsAPIClient] = {}
 
         if events_channels:
             self.logger.info("Setting up GitHub events API integration (channels enabled: %r)", events_channels)
-            self.github_events_api_client = GithubEventsAPIClient("blue-nebula")
-            self.github_events_api_client.setup()
+
+            max_poll_interval = float(self._relbot_config().get("github_events_max_poll_interval", 600))
+            per_page = int(self._relbot_config().get("github_events_per_page", 30))
+
+            # we continue where we left off last time
+            # sources we don't know yet are set up in the background once the bot has connected
+            self.state_store = GitHubEventsStateStore(
+                self._relbot_config().get("github_events_state_file", "github_events_state.json")
+            )
+            self.state_store.load()
+
+            for source in self._get_github_events_sources():
+                client = GithubEventsAPIClient(source, max_poll_interval, per_page)
+
+                state = self.state_store.get(source)
+
+                if state is not None:
+                    client.restore_state(state)
+
+                self.github_events_api_clients[source] = client
+
             self.logger.info("Finished setting up GitHub events API integration")
 
         else:
             self.logger.info("GitHub events API integration disabled")
-            self.github_events_api_client = None
+            self.state_store = None
+
+        # limits the amount of sources which are polled at the same time
+        max_concurrent_polls = int(self._relbot_config().get("github_events_max_concurrent_polls", 4))
+        self.polls_semaphore = asyncio.Semaphore(max_concurrent_polls)
+
+        # related events are collected for a while and then reported as a digest, with a limited number of lines at a
+        # time
+        # a window of 0 reports the events right after every poll
+        # every channel gets its own digest, as they might receive different events
+        self.digest_window = float(self._relbot_config().get("github_events_digest_window", 60))
+        digest_max_lines = int(self._relbot_config().get("github_events_digest_max_lines", 5))
+        self.digests: Dict[str, GitHubEventsDigest] = {c: GitHubEventsDigest(digest_max_lines) for c in events_channels}
+
+        # the checkpoint of a poll is only persisted once its events have left the digests, so events which are still
+        # waiting there are reported again after a restart instead of being lost
+        # source -> checkpoints in the order of the polls: (state, channel -> digest's added_count to wait for)
+        self._pending_checkpoints: Dict[str, Deque[Tuple[dict, Dict[str, int]]]] = {}
+
+        self._polling_tasks: List[asyncio.Task] = []
+
+        # optionally, GitHub can push events to us via webhooks, which is a lot faster than polling
+        # polling continues as a fallback, but its events are only reported if no webhook deliveries have been received
+        # for their repositories for a while
+        self.webhook_server: Union[GitHubWebhookServer, None] = None
+        self.webhook_fallback_timeout = float(self._relbot_config().get("github_webhook_fallback_timeout", 600))
+
+        webhook_listen = self._relbot_config().get("github_webhook_listen", None)
+
+        if webhook_listen and events_channels:
+            host, port = webhook_listen.rsplit(":", 1)
+
+            self.webhook_server = GitHubWebhookServer(
+                host,
+                int(port),
+                self._relbot_config()["github_webhook_secret"],
+                self.handle_webhook_event,
+                self._relbot_config().get("github_webhook_path", "/"),
+            )
 
     def _relbot_config(self):
         return self.bot.config.get("relbot", dict())
 
-    def _get_github_events_channels(self):
-        config_key = "github_events_channels"
-
-        config_value = self._relbot_config().get(config_key)
+    def _get_config_list(self, config_key: str, default=None):
+        config_value = self._relbot_config().get(config_key, default)
 
         # not too Pythonic, but both str and list are iterable...
         if isinstance(config_value, str):
@@ -42,39 +122,265 @@ class RELBotGitHubEventsFeedPlugin:
         else:
             raise ValueError("Unsupported value for %s: %r", config_key, config_value)
 
-    @cron("*/1 * * * *")
-    def check_github_events(self):
-        channels = self._get_github_events_channels()
+    def _get_config_lines(self, config_key: str) -> List[str]:
+        # irc3 turns values spanning multiple lines into lists
+        config_value = self._relbot_config().get(config_key, [])
+
+        if isinstance(config_value, str):
+            return [config_value] if config_value.strip() else []
+        elif isinstance(config_value, list):
+            return config_value
+        else:
+            raise ValueError("Unsupported value for %s: %r", config_key, config_value)
+
+    def _get_github_events_channels(self):
+        # these channels receive all events, further channels can be configured with routes
+        return self._get_config_list("github_events_channels", [])
+
+    def _get_github_events_sources(self):
+        # organizations (e.g., blue-nebula) or repositories (e.g., blue-nebula/base)
+        return self._get_config_list("github_events_sources", "blue-nebula")
+
+    def warm_issue_cache(self, events: Iterable[GitHubEvent]):
+        """
+        Let the chat monitor know about the issues and pull requests which have been active recently. These are the
+        ones most likely to be mentioned in the channels.
+        """
+
+        # the events are sorted in descending order, the most recent information should win
+        count = sum(self.issue_cache.put_from_event(event) for event in reversed(list(events)))
+
+        self.logger.debug("added %d issues to issue cache", count)
+
+    def _is_watched_repo(self, repo: str) -> bool:
+        sources = {s.lower() for s in self._get_github_events_sources()}
+        repo = repo.lower()
+        return repo in sources or repo.split("/", 1)[0] in sources
+
+    def _delivered_via_webhook(self, event: GitHubEvent) -> bool:
+        if self.webhook_server is None:
+            return False
+
+        key = (event.repo.lower(), event.type)
+        last_delivery_at = self.webhook_server.last_delivery_at_by_repo_event.get(key, None)
+
+        if last_delivery_at is None:
+            return False
+
+        return time.monotonic() - last_delivery_at < self.webhook_fallback_timeout
+
+    def handle_webhook_event(self, event: GitHubEvent):
+        # the webhook might be configured for more repositories than we are supposed to report on
+        if not self._is_watched_repo(event.repo):
+            self.logger.debug("ignoring webhook event for %s", event.repo)
+            return
+
+        self.warm_issue_cache([event])
+
+        self.dispatch([event])
+
+    async def start_webhook_server(self):
+        try:
+            await self.webhook_server.start()
+
+        except OSError:
+            self.logger.exception("failed to start webhook server, falling back to polling")
+            self.webhook_server = None
+
+    @irc3.event(irc3.rfc.CONNECTED)
+    def start_polling(self, **kwargs):
+        # we might reconnect, but we only need to poll once
+        if any(not task.done() for task in self._polling_tasks):
+            return
+
+        if self.webhook_server is not None:
+            self._polling_tasks.append(self.bot.create_task(self.start_webhook_server()))
+
+        # the polls are spread evenly over the default poll interval, so they don't all happen at the same time
+        stagger = GithubEventsAPIClient.DEFAULT_POLL_INTERVAL / max(1, len(self.github_events_api_clients))
+
+        self._polling_tasks += [
+            self.bot.create_task(self.poll_github_events(client, i * stagger))
+            for i, client in enumerate(self.github_events_api_clients.values())
+        ]
+
+        if self.digest_window > 0:
+            self._polling_tasks.append(self.bot.create_task(self.report_digest_periodically()))
+
+    async def poll_github_events(self, client: GithubEventsAPIClient, phase: float):
+        """
+        Instead of polling in fixed intervals, the client tells us when to poll next, based on the recent activity and
+        GitHub's response headers.
+        Every poll is postponed to the source's phase within the default poll interval, so the sources stay staggered
+        even when their delays change.
+        """
+
+        loop = asyncio.get_running_loop()
+        period = GithubEventsAPIClient.DEFAULT_POLL_INTERVAL
+
+        scheduled_at = align_poll_time(loop.time(), phase, period)
+
+        while True:
+            await asyncio.sleep(max(0.0, scheduled_at - loop.time()))
+
+            try:
+                async with self.polls_semaphore:
+                    await self.check_github_events(client)
+
+            except:  # noqa
+                self.logger.exception("unknown error while checking GitHub events of %s", client.source)
+
+            # all sources share the same rate limit
+            delay = client.next_poll_delay(len(self.github_events_api_clients))
+            scheduled_at = align_poll_time(max(scheduled_at + delay, loop.time()), phase, period)
+
+            self.logger.debug(
+                "next poll of GitHub events of %s in %.0f seconds", client.source, scheduled_at - loop.time()
+            )
+
+    async def check_github_events(self, client: GithubEventsAPIClient):
+        channels = self.router.channels
 
         if not channels:
-            self.logger.debug("cron job check_github_events skipped: no channels configured")
+            self.logger.debug("check_github_events skipped: no channels configured")
             return
 
-        self.logger.info("cron job running: check_github_events %r", channels)
+        self.logger.info("running check_github_events for %s %r", client.source, channels)
+
+        # the first time we see a source, we just remember what has happened so far
+        if client.last_reported_id < 0:
+            self.logger.info("setting up %s", client.source)
+
+            # the request is blocking, so it must not run in the event loop's thread
+            self.warm_issue_cache(await asyncio.to_thread(client.setup))
+            self.state_store.update(client.source, client.get_state())
+
+            return
 
         try:
             # need a list to be able to slice and reverse the events
-            events = list(self.github_events_api_client.fetch_new_events())
+            # the request is blocking, so it must not run in the event loop's thread
+            events = await asyncio.to_thread(lambda: list(client.fetch_new_events()))
 
         except requests.exceptions.HTTPError as e:
             # might have run into a rate limit
             # just ignore it for now
-            self.logger.error("HTTP error while fetching events from GitHub:", e)
+            self.logger.error("HTTP error while fetching events of %s from GitHub: %s", client.source, e)
 
         else:
-            for event in reversed(events):
-                notice = format_github_event(event)
+            self.warm_issue_cache(events)
 
-                self.logger.info(notice)
+            if not events:
+                self.logger.info(format_github_event("no new events to report"))
 
-                for target in channels:
-                    self.bot.notice(target, notice)
+            # events of repositories which webhooks work for have been (or will be) delivered via webhooks already
+            polled_events = [event for event in events if not self._delivered_via_webhook(event)]
 
-            else:
-                self.logger.info(format_github_event("no new events to report"))
+            if len(polled_events) < len(events):
+                self.logger.debug("%d events have been reported via webhooks already", len(events) - len(polled_events))
+
+            targets = self.dispatch(reversed(polled_events))
+
+            self._pending_checkpoints.setdefault(client.source, deque()).append((client.get_state(), targets))
+            self._save_reported_checkpoints()
+
+    def _save_reported_checkpoints(self):
+        for source, checkpoints in self._pending_checkpoints.items():
+            state = None
+
+            # the checkpoints of a source must be saved in order, later polls might have gone to other channels
+            # channels which have been removed in the meantime (e.g., on reload) don't have anything left to report
+            while checkpoints and all(
+                channel not in self.digests or self.digests[channel].reported_count >= count
+                for channel, count in checkpoints[0][1].items()
+            ):
+                state, _ = checkpoints.popleft()
+
+            if state is not None:
+                self.state_store.update(source, state)
+
+    def dispatch(self, events: Iterable[GitHubEvent]) -> Dict[str, int]:
+        """
+        Pass events to the digests of the channels which are subscribed to them.
+        :param events: events in chronological order (i.e., oldest first)
+        :return: channel -> digest's added_count after adding the events, for all channels which received any
+        """
+
+        targets = {}
+
+        for event in events:
+            for channel in self.router.route(event):
+                digest = self.digests[channel]
+                digest.add([event])
+                targets[channel] = digest.added_count
+
+        if self.digest_window <= 0:
+            self.report_digest()
+
+        return targets
+
+    def report_digest(self):
+        for channel, digest in self.digests.items():
+            for notice in digest.pop_lines():
+                self.logger.info("%s: %s", channel, notice)
+                self.outbound.notice(channel, notice, Priority.FEED)
+
+            if digest:
+                self.logger.info("%s: %d events and lines left in digest", channel, len(digest))
+
+        self._save_reported_checkpoints()
+
+    async def report_digest_periodically(self):
+        while True:
+            await asyncio.sleep(self.digest_window)
+
+            try:
+                self.report_digest()
+
+            except:  # noqa
+                self.logger.exception("unknown error while reporting GitHub events digest")
+
+    @classmethod
+    def reload(cls, old):
+        new = cls(old.bot)
+
+        # events which have not been reported yet must not get lost
+        for channel, digest in old.digests.items():
+            if channel in new.digests:
+                digest.max_lines = new.digests[channel].max_lines
+                new.digests[channel] = digest
 
-    @command(name="test-gh-events", permssion="admin", show_in_help_list=False)
-    def test_proxy(self, mask, target, args):
+        if new.state_store is not None:
+            new._pending_checkpoints = old._pending_checkpoints
+
+        # the port must be released before the new instance can listen on it
+        if old.webhook_server is not None:
+            old.webhook_server.close()
+
+        # the polling tasks belong to the old instance, so they have to be replaced
+        if any(not task.done() for task in old._polling_tasks):
+            for task in old._polling_tasks:
+                task.cancel()
+
+            new.start_polling()
+
+        return new
+
+    @staticmethod
+    def _fetch_latest_events(clients: List[GithubEventsAPIClient]) -> List[GitHubEvent]:
+        events = []
+
+        for client in clients:
+            # the pollers' clients must not be touched, their cached pages and checkpoints belong to the poll loop
+            fresh_client = GithubEventsAPIClient(client.source, api_url=client.api_url)
+            events += fresh_client.fetch_events()
+
+        events.sort(key=lambda i: i.id, reverse=True)
+
+        return events
+
+    @command(name="test-gh-events", permission="admin", show_in_help_list=False)
+    async def test_proxy(self, mask, target, args):
         """Fetch last n events from GitHub events API
 
             %%test-gh-events <limit>
@@ -83,18 +389,19 @@ class RELBotGitHubEventsFeedPlugin:
         try:
             limit = int(args["<limit>"])
         except ValueError:
-            yield "invalid argument: not an int: %s" % args["<limit>"]
-            return
+            return "invalid argument: not an int: %s" % args["<limit>"]
 
         try:
-            events = self.github_events_api_client.fetch_events()
+            # the requests are blocking, so they must not run in the event loop's thread
+            # new sources may be added meanwhile, so the thread gets a copy of the clients
+            clients = list(self.github_events_api_clients.values())
+            events = await asyncio.to_thread(self._fetch_latest_events, clients)
 
         except requests.exceptions.HTTPError as e:
             # might have run into a rate limit
-            # just ignore it for now
-            print("HTTP error while fetching events from GitHub:", e)
+            self.logger.warning("HTTP error while fetching events from GitHub: %s", e)
+            return "HTTP error while fetching events from GitHub: %s" % e
 
-        else:
-            for event in reversed(events[:limit]):
-                notice = format_github_event(event)
-                self.bot.notice(target, notice)
+        for event in reversed(events[:limit]):
+            notice = format_github_event(event)
+            self.outbound.notice(target, notice, Priority.INTERACTIVE)
@@ -0,0 +1,146 @@
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Union
+
+from relbot.github_events_api_client import GitHubEvent
+
+
+# matches any event type or repository in the routing index
+WILDCARD = "*"
+
+
+class EventRoute(NamedTuple):
+    """
+    Subscription of a channel. Repositories and event types are part of the routing index, the remaining filters are
+    checked per route. None matches anything.
+    """
+
+    channel: str
+    actions: Union[FrozenSet[str], None]
+    branches: Union[FrozenSet[str], None]
+
+    def matches(self, event: GitHubEvent) -> bool:
+        if self.actions is not None and getattr(event.payload, "action", None) not in self.actions:
+            return False
+
+        if self.branches is not None and event_branch(event) not in self.branches:
+            return False
+
+        return True
+
+
+def event_branch(event: GitHubEvent) -> Union[str, None]:
+    """
+    Branch an event refers to, if any.
+    """
+
+    payload = event.payload
+
+    if event.type == "PushEvent":
+        ref = payload.ref
+
+        if ref.startswith("refs/heads/"):
+            return ref[len("refs/heads/") :]
+
+        return ref
+
+    if getattr(payload, "ref_type", None) == "branch":
+        return payload.ref
+
+    return None
+
+
+def _parse_filter_values(value: str) -> FrozenSet[str]:
+    return frozenset(v for v in value.split(",") if v)
+
+
+class GitHubEventsRouter:
+    """
+    Decides which channels an event is reported to. The routes are compiled into an index once, so routing an event
+    only costs as much as the number of routes which might match it.
+
+    Every route is configured on a single line: the channel, followed by any number of filters, e.g.:
+
+        #releases type=ReleaseEvent
+        #base-dev repo=blue-nebula/base type=PushEvent,PullRequestEvent action=opened,closed branch=master
+
+    Multiple values of a filter are separated by commas. Filters which are not specified match anything.
+    """
+
+    FILTERS = ("repo", "type", "action", "branch")
+
+    def __init__(self, routes: Iterable[str], default_channels: Iterable[str] = ()):
+        """
+        :param routes: route specifications as described above
+        :param default_channels: channels which receive all events
+        """
+
+        # event type -> repository (lower-case) -> routes
+        self._index: Dict[str, Dict[str, List[EventRoute]]] = {}
+
+        # all channels which receive any events, mapped to the order they were configured in
+        self._channels: Dict[str, int] = OrderedDict()
+
+        for channel in default_channels:
+            self._add(channel, [WILDCARD], [WILDCARD], None, None)
+
+        for spec in routes:
+            self._add_route_spec(spec)
+
+    def _add(self, channel: str, repos, event_types, actions, branches):
+        route = EventRoute(channel, actions, branches)
+
+        for event_type in event_types:
+            repos_index = self._index.setdefault(event_type, {})
+
+            for repo in repos:
+                repos_index.setdefault(repo.lower(), []).append(route)
+
+        self._channels.setdefault(channel, len(self._channels))
+
+    def _add_route_spec(self, spec: str):
+        channel, *filters = spec.split()
+
+        values: Dict[str, FrozenSet[str]] = {}
+
+        for filter_ in filters:
+            key, _, value = filter_.partition("=")
+
+            if key not in self.FILTERS or not value:
+                raise ValueError("invalid filter in route %r: %s" % (spec, filter_))
+
+            values[key] = _parse_filter_values(value)
+
+        self._add(
+            channel,
+            values.get("repo", [WILDCARD]),
+            values.get("type", [WILDCARD]),
+            values.get("action", None),
+            values.get("branch", None),
+        )
+
+    @property
+    def channels(self) -> List[str]:
+        return list(self._channels)
+
+    def route(self, event: GitHubEvent) -> List[str]:
+        """
+        :return: channels the event shall be reported to, in the order they were configured
+        """
+
+        repo = event.repo.lower()
+
+        channels: Dict[str, None] = {}
+
+        for event_type in (event.type, WILDCARD):
+            repos_index = self._index.get(event_type, None)
+
+            if repos_index is None:
+                continue
+
+            for repo_key in (repo, WILDCARD):
+                for route in repos_index.get(repo_key, ()):
+                    if route.channel not in channels and route.matches(event):
+                        channels[route.channel] = None
+
+        # keep the order stable, independent of which index bucket matched first
+        return sorted(channels, key=self._channels.__getitem__)
@@ -0,0 +1,50 @@
+import json
+from typing import Dict, Union
+
+from relbot.util import atomic_write, make_logger
+
+
+class GitHubEventsStateStore:
+    """
+    Persists the state of the GitHub events API clients (i.e., the last reported event and the HTTP validators) in a
+    small JSON file, so that restarts neither need to wait for GitHub nor lose any events.
+    The file is replaced atomically, so it never ends up half-written.
+    """
+
+    def __init__(self, path: str):
+        self.logger = make_logger(self.__class__.__name__)
+
+        self.path = path
+
+        # source -> state
+        self._states: Dict[str, dict] = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self._states = json.load(f)
+
+        except FileNotFoundError:
+            self.logger.info("state file %s does not exist yet", self.path)
+            self._states = {}
+
+        except (OSError, ValueError):
+            self.logger.exception("failed to load state file %s, ignoring it", self.path)
+            self._states = {}
+
+    def get(self, source: str) -> Union[dict, None]:
+        return self._states.get(source, None)
+
+    def update(self, source: str, state: dict):
+        if self._states.get(source, None) == state:
+            return
+
+        self._states[source] = state
+        self.save()
+
+    def save(self):
+        try:
+            atomic_write(self.path, json.dumps(self._states).encode())
+
+        except OSError:
+            self.logger.exception("failed to save state file %s", self.path)
@@ -0,0 +1,134 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple, Union
+
+import irc3
+from irc3.plugins.command import command
+
+from relbot.github_issue_resolver import ResolvedGitHubIssue, entity_type_from_url
+from relbot.github_issues_matcher import GitHubIssue
+from relbot.util import make_logger
+
+
+@irc3.plugin
+class GitHubIssueCache:
+    """
+    Bounded LRU cache of resolved GitHub issues, shared between all channels.
+    Entries expire after a configurable time. Issues which could not be found (e.g., because they do not exist or the
+    repository is private) are cached as well, but typically with a shorter TTL.
+    """
+
+    def __init__(self, bot):
+        self.logger = make_logger(self.__class__.__name__)
+
+        self.bot = bot
+
+        config = self.bot.config.get("github_chat_monitor", dict())
+
+        self.max_size = int(config.get("cache_size", 1024))
+        self.ttl = float(config.get("cache_ttl", 3600))
+        self.negative_ttl = float(config.get("cache_negative_ttl", 300))
+
+        # maps the unique issue IDs to the time the entry expires and the resolved issue
+        self._entries: Dict[str, Tuple[float, ResolvedGitHubIssue]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(issue: GitHubIssue) -> str:
+        # same unique ID as used by GitHubIssuesMatcher.deduplicate
+        return issue.unique_id
+
+    def get(self, issue: GitHubIssue) -> Union[ResolvedGitHubIssue, None]:
+        key = self.make_key(issue)
+
+        try:
+            expires_at, resolved = self._entries[key]
+
+        except KeyError:
+            self.misses += 1
+            return None
+
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return resolved
+
+    def put(self, resolved: ResolvedGitHubIssue):
+        if resolved.found:
+            ttl = self.ttl
+        else:
+            ttl = self.negative_ttl
+
+        if ttl <= 0 or self.max_size <= 0:
+            return
+
+        key = self.make_key(resolved.issue)
+
+        self._entries[key] = (time.monotonic() + ttl, resolved)
+        self._entries.move_to_end(key)
+
+        # evict least recently used entries
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def put_from_event(self, event) -> bool:
+        """
+        Store the issue or pull request a GitHub event refers to, if any.
+        Events on issues and pull requests carry all the information we need, so recently active issues can be
+        reported without any further requests.
+        :param event: GitHubEvent
+        :return: whether the event contained an issue
+        """
+
+        payload = event.payload
+
+        try:
+            number, title, url = payload.number, payload.title, payload.url
+
+        except AttributeError:
+            return False
+
+        repo_owner, repo_name = event.repo.split("/", 1)
+
+        # the numbers are formatted already
+        issue = GitHubIssue(repo_owner, repo_name, str(number).lstrip("#"))
+
+        self.put(ResolvedGitHubIssue(issue, entity_type_from_url(url), title, url))
+
+        return True
+
+    def flush(self) -> int:
+        count = len(self._entries)
+        self._entries.clear()
+        return count
+
+    def __len__(self):
+        return len(self._entries)
+
+    @command(name="github-cache-flush", permission="admin")
+    def flush_command(self, mask, target, args):
+        """Flush cache of resolved GitHub issues
+
+            %%github-cache-flush
+        """
+
+        count = self.flush()
+        self.logger.info("flushed %d entries", count)
+
+        yield "Flushed %d entries" % count
+
+    @command(name="github-cache-stats", permission="admin", show_in_help_list=False)
+    def stats_command(self, mask, target, args):
+        """Show statistics of cache of resolved GitHub issues
+
+            %%github-cache-stats
+        """
+
+        yield "%d/%d entries, %d hits, %d misses" % (len(self), self.max_size, self.hits, self.misses)
@@ -0,0 +1,443 @@
+from typing import NamedTuple, Union, List, Dict, Tuple, Iterable
+
+import requests
+from lxml import etree, html
+
+from relbot.github_issues_matcher import GitHubIssue
+from relbot.util import managed_proxied_session, managed_session, make_logger, format_github_event
+
+
+class GitHubIssueResolverError(Exception):
+    """
+    Thrown whenever a GitHub issue could not be resolved for reasons other than the issue not existing (e.g., network
+    errors or unexpected responses).
+    """
+
+    pass
+
+
+class ResolvedGitHubIssue(NamedTuple):
+    issue: GitHubIssue
+    # one of PR, Issue, Discussion or Unknown Entity, None if the issue could not be found
+    type: Union[str, None]
+    title: Union[str, None]
+    url: str
+
+    @property
+    def found(self) -> bool:
+        return self.title is not None
+
+    def format_notice(self) -> str:
+        if not self.found:
+            # by providing a link, issues and PRs can still be accessed easily in case a repo is private
+            # if it just doesn't exist, users will see an error message on GitHub
+            message = (
+                f"Could not find any information on {self.issue} "
+                f"(repository might be private, you can still try to open {self.url})"
+            )
+
+        else:
+            message = "{} #{}: {} ({})".format(self.type, self.issue.issue_id, self.title, self.url)
+
+        return format_github_event(message)
+
+
+def entity_type_from_url(url: str) -> str:
+    url_parts = url.split("/")
+
+    if "pull" in url_parts:
+        return "PR"
+    elif "issues" in url_parts:
+        return "Issue"
+    elif "discussions" in url_parts:
+        return "Discussion"
+    else:
+        return "Unknown Entity"
+
+
+class GitHubIssueResolverBackend:
+    """
+    Base class for the different ways to look up GitHub issues.
+    All methods are blocking, they must not be run within the event loop's thread.
+    """
+
+    # batched backends can resolve any number of issues with a single request
+    batched = False
+
+    def __init__(self):
+        self._logger = make_logger(self.__class__.__name__)
+
+    def resolve_many(self, issues: List[GitHubIssue]) -> Dict[str, ResolvedGitHubIssue]:
+        """
+        Resolve all the given issues. The results are indexed by the issues' unique IDs.
+        Issues the backend cannot tell anything about are left out, callers should fall back to another backend for
+        those.
+        """
+
+        raise NotImplementedError()
+
+
+class GitHubIssueScraper(GitHubIssueResolverBackend):
+    """
+    Resolves GitHub issues by scraping their web pages.
+    GitHub automatically redirects issue URLs to pull requests or discussions, so we can always use the issues URL.
+
+    In streaming mode (the default), the page is parsed incrementally while it is downloaded, and the download is
+    aborted as soon as the title has been found. The title is located at the beginning of the page, so this saves most
+    of the bandwidth, CPU time and memory needed to process the rest of the (potentially huge) discussion.
+    """
+
+    # size of the chunks fed to the parser in streaming mode
+    CHUNK_SIZE = 16 * 1024
+
+    def __init__(self, streaming: bool = True):
+        super().__init__()
+
+        self.streaming = streaming
+
+    @staticmethod
+    def build_url(issue: GitHubIssue) -> str:
+        return f"https://github.com/{issue.repo_owner}/{issue.repo_name}/issues/{issue.issue_id}"
+
+    @staticmethod
+    def parse_title(content: bytes) -> str:
+        tree = html.fromstring(content)
+
+        try:
+            title = tree.cssselect("[data-testid=issue-header] bdi")[0].text
+        except IndexError:
+            title = tree.cssselect(".gh-header-title .js-issue-title")[0].text
+
+        return title.strip(" \r\n")
+
+    @staticmethod
+    def _has_ancestor(element, attribute: str, value: str, is_class: bool = False) -> bool:
+        for ancestor in element.iterancestors():
+            ancestor_value = ancestor.get(attribute)
+
+            if ancestor_value is None:
+                continue
+
+            if is_class and value in ancestor_value.split():
+                return True
+
+            if ancestor_value == value:
+                return True
+
+        return False
+
+    @classmethod
+    def _is_title_element(cls, element) -> bool:
+        # equivalent to the CSS selectors used in parse_title
+        if element.tag == "bdi":
+            return cls._has_ancestor(element, "data-testid", "issue-header")
+
+        classes = element.get("class")
+
+        if classes and "js-issue-title" in classes.split():
+            return cls._has_ancestor(element, "class", "gh-header-title", is_class=True)
+
+        return False
+
+    @classmethod
+    def parse_title_streaming(cls, chunks: Iterable[bytes]) -> str:
+        """
+        Incremental variant of parse_title. Stops consuming chunks as soon as the title has been found.
+        """
+
+        parser = etree.HTMLPullParser(events=("end",))
+
+        for chunk in chunks:
+            parser.feed(chunk)
+
+            for _, element in parser.read_events():
+                if cls._is_title_element(element):
+                    return element.text.strip(" \r\n")
+
+                # we do not need elements we have seen completely any more, so we can free their memory
+                # their ancestors have not been completed yet, therefore they are still intact
+                element.clear()
+
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        raise IndexError("title not found")
+
+    def _fetch_title(self, session, url: str):
+        if not self.streaming:
+            response = session.get(url, allow_redirects=True)
+            return response, lambda: self.parse_title(response.content)
+
+        # when streaming, the body is only downloaded while it is being parsed
+        response = session.get(url, allow_redirects=True, stream=True)
+
+        def parse():
+            # closing the response aborts the download of the rest of the page
+            with response:
+                return self.parse_title_streaming(response.iter_content(self.CHUNK_SIZE))
+
+        return response, parse
+
+    def resolve(self, issue: GitHubIssue) -> ResolvedGitHubIssue:
+        """
+        Blocking call, must not be run within the event loop's thread.
+        """
+
+        url = self.build_url(issue)
+
+        self._logger.debug("fetching %s", url)
+
+        try:
+            with managed_proxied_session() as session:
+                response, parse = self._fetch_title(session, url)
+
+                if response.status_code == 404:
+                    response.close()
+                    return ResolvedGitHubIssue(issue, None, None, url)
+
+                if response.status_code != 200:
+                    response.close()
+                    raise GitHubIssueResolverError("HTTP status %d" % response.status_code)
+
+                try:
+                    title = parse()
+                except (IndexError, AttributeError):
+                    raise GitHubIssueResolverError("could not find title on %s" % response.url)
+
+        except requests.exceptions.RequestException as e:
+            raise GitHubIssueResolverError("request to %s failed: %s" % (url, e))
+
+        return ResolvedGitHubIssue(issue, entity_type_from_url(response.url), title, response.url)
+
+    def resolve_many(self, issues: List[GitHubIssue]) -> Dict[str, ResolvedGitHubIssue]:
+        return {issue.unique_id: self.resolve(issue) for issue in issues}
+
+
+class GitHubAPIBackend(GitHubIssueResolverBackend):
+    """
+    Base class for backends using GitHub's APIs. The API URL can be changed, e.g., to use a local test server.
+    Loopback API URLs are connected to directly, everything else is reached via the proxy.
+    """
+
+    def __init__(self, api_url: str = None, token: str = None):
+        super().__init__()
+
+        if api_url is None:
+            api_url = "https://api.github.com"
+
+        self.api_url = api_url.rstrip("/")
+        self.token = token
+
+    def _headers(self) -> Dict[str, str]:
+        headers = {
+            "accept": "application/vnd.github+json",
+        }
+
+        if self.token:
+            headers["authorization"] = "bearer %s" % self.token
+
+        return headers
+
+
+class GitHubRESTBackend(GitHubAPIBackend):
+    """
+    Resolves issues and pull requests with GitHub's REST API. The responses are a lot smaller than the web pages.
+    The REST API does not know about discussions, those are left to the fallback.
+    Works without a token, but the rate limit for anonymous requests is rather low.
+    """
+
+    def resolve(self, issue: GitHubIssue) -> Union[ResolvedGitHubIssue, None]:
+        url = f"{self.api_url}/repos/{issue.repo_owner}/{issue.repo_name}/issues/{issue.issue_id}"
+
+        try:
+            with managed_session(self.api_url) as session:
+                response = session.get(url, allow_redirects=True, headers=self._headers())
+
+        except requests.exceptions.RequestException as e:
+            raise GitHubIssueResolverError("request to %s failed: %s" % (url, e))
+
+        # might as well be a discussion, or a private repository
+        if response.status_code == 404:
+            return None
+
+        # deleted issues
+        if response.status_code == 410:
+            return ResolvedGitHubIssue(issue, None, None, GitHubIssueScraper.build_url(issue))
+
+        if response.status_code != 200:
+            raise GitHubIssueResolverError("HTTP status %d" % response.status_code)
+
+        data = response.json()
+
+        if data.get("pull_request", None):
+            type_ = "PR"
+        else:
+            type_ = "Issue"
+
+        return ResolvedGitHubIssue(issue, type_, data["title"].strip(" \r\n"), data["html_url"])
+
+    def resolve_many(self, issues: List[GitHubIssue]) -> Dict[str, ResolvedGitHubIssue]:
+        results = {}
+
+        for issue in issues:
+            resolved = self.resolve(issue)
+
+            if resolved is not None:
+                results[issue.unique_id] = resolved
+
+        return results
+
+
+class GitHubGraphQLBackend(GitHubAPIBackend):
+    """
+    Resolves any number of issues, pull requests and discussions with a single GitHub GraphQL API query.
+    GitHub requires a token for all GraphQL requests.
+    """
+
+    batched = True
+
+    TYPES = {
+        "Issue": "Issue",
+        "PullRequest": "PR",
+        "Discussion": "Discussion",
+    }
+
+    @staticmethod
+    def build_query(issues: List[GitHubIssue]) -> Tuple[str, dict]:
+        """
+        Build a query which looks up all issues at once. Every issue gets its own alias, the values are passed as
+        variables, so we do not have to care about escaping.
+        """
+
+        parameters = []
+        fields = []
+        variables = {}
+
+        for i, issue in enumerate(issues):
+            parameters.append(f"$owner{i}: String!, $name{i}: String!, $number{i}: Int!")
+
+            fields.append(
+                f"issue{i}: repository(owner: $owner{i}, name: $name{i}) {{ "
+                f"issueOrPullRequest(number: $number{i}) {{ "
+                f"__typename ... on Issue {{ title url }} ... on PullRequest {{ title url }} }} "
+                f"discussion(number: $number{i}) {{ __typename title url }} "
+                f"}}"
+            )
+
+            variables[f"owner{i}"] = issue.repo_owner
+            variables[f"name{i}"] = issue.repo_name
+            variables[f"number{i}"] = int(issue.issue_id)
+
+        query = "query(%s) { %s }" % (", ".join(parameters), " ".join(fields))
+
+        return query, variables
+
+    def resolve_many(self, issues: List[GitHubIssue]) -> Dict[str, ResolvedGitHubIssue]:
+        if not self.token:
+            raise GitHubIssueResolverError("GraphQL API requires a token")
+
+        url = self.api_url + "/graphql"
+
+        query, variables = self.build_query(issues)
+
+        try:
+            with managed_session(self.api_url) as session:
+                response = session.post(url, json={"query": query, "variables": variables}, headers=self._headers())
+
+        except requests.exceptions.RequestException as e:
+            raise GitHubIssueResolverError("request to %s failed: %s" % (url, e))
+
+        if response.status_code != 200:
+            raise GitHubIssueResolverError("HTTP status %d" % response.status_code)
+
+        data = response.json().get("data", None)
+
+        # entities which do not exist are reported as errors, but we still get the data for all the others
+        if data is None:
+            raise GitHubIssueResolverError("GraphQL query failed: %r" % response.json().get("errors", None))
+
+        results = {}
+
+        for i, issue in enumerate(issues):
+            repository = data.get(f"issue{i}", None)
+
+            # the repository does not exist or is private
+            if repository is None:
+                results[issue.unique_id] = ResolvedGitHubIssue(issue, None, None, GitHubIssueScraper.build_url(issue))
+                continue
+
+            entity = repository.get("issueOrPullRequest", None) or repository.get("discussion", None)
+
+            if entity is None:
+                results[issue.unique_id] = ResolvedGitHubIssue(issue, None, None, GitHubIssueScraper.build_url(issue))
+                continue
+
+            type_ = self.TYPES.get(entity["__typename"], "Unknown Entity")
+
+            results[issue.unique_id] = ResolvedGitHubIssue(issue, type_, entity["title"].strip(" \r\n"), entity["url"])
+
+        return results
+
+
+def make_backend(
+    name: str, api_url: str = None, token: str = None, scraper: GitHubIssueScraper = None
+) -> GitHubIssueResolverBackend:
+    """
+    :param scraper: scraper to use for the scraper backend, so it can be shared with the fallback
+    """
+
+    if name == "scraper":
+        if scraper is None:
+            scraper = GitHubIssueScraper()
+
+        return scraper
+
+    elif name == "rest":
+        return GitHubRESTBackend(api_url, token)
+
+    elif name == "graphql":
+        return GitHubGraphQLBackend(api_url, token)
+
+    raise ValueError("unknown GitHub issue resolver backend: %s" % name)
+
+
+if __name__ == "__main__":
+    # benchmark of the title extraction on recorded pages
+    # usage: python -m relbot.github_issue_resolver <page.html>...
+    import resource
+    import subprocess
+    import sys
+    import time
+
+    if sys.argv[1] == "--measure":
+        # runs in a separate process to be able to measure the peak memory usage of a single mode
+        mode, path = sys.argv[2:4]
+
+        def read_chunks():
+            with open(path, "rb") as f:
+                while True:
+                    chunk = f.read(GitHubIssueScraper.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        start = time.perf_counter()
+
+        if mode == "streaming":
+            GitHubIssueScraper.parse_title_streaming(read_chunks())
+        else:
+            GitHubIssueScraper.parse_title(b"".join(read_chunks()))
+
+        duration = time.perf_counter() - start
+
+        # ru_maxrss is reported in KiB on Linux
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("%-9s %8.2f ms %8d KiB peak RSS" % (mode, duration * 1e3, peak_rss))
+
+    else:
+        for path in sys.argv[1:]:
+            print(path)
+
+            for mode in ["full", "streaming"]:
+                command = [sys.executable, "-m", "relbot.github_issue_resolver", "--measure", mode, path]
+                subprocess.run(command, check=True)
@@ -1,6 +1,4 @@
 import re
-import string
-import urllib.parse
 from typing import NamedTuple, List, Dict
 
 from relbot.util import make_logger
@@ -30,93 +28,159 @@ class GitHubIssue(NamedTuple):
 
         return issue_text_id
 
+    @property
+    def unique_id(self) -> str:
+        # the unique text ID is not case-sensitive, so we just enforce lower-case to make them unique
+        return str(self).lower()
+
+
+# short references like #123, repo#123 or owner/repo#123
+# this regex will just match any string, even if embedded in some other string
+# the idea is that when there's e.g., punctuation following an issue number, it will still trigger the integration
+# we require a whitespace character (or the beginning of the message) in front of the reference to prevent
+# false-positive matches within random strings, e.g., URLs with query strings
+# as matches can only start after whitespace, every word is scanned a constant number of times, even on adversarial
+# input
+_SHORT_REFERENCE_PATTERN = r"(?:(?<=\s)|^)(?:([A-Za-z_-]+)/)?([A-Za-z_-]+)?#([0-9]+)"
+
+# links to issues, pull requests and discussions
+# the character classes cannot match slashes, therefore the pattern cannot backtrack across path components
+_URL_PATTERN = r"https://github\.com/([A-Za-z0-9_.-]+)/([A-Za-z0-9_.-]+)/(?:issues|pull|discussions)/([0-9]+)"
+
+# a single pattern to find both kinds of references in one pass over the message
+_REFERENCES_REGEX = re.compile("%s|%s" % (_SHORT_REFERENCE_PATTERN, _URL_PATTERN))
+
+_SHORT_REFERENCE_REGEX = re.compile(_SHORT_REFERENCE_PATTERN)
+_URL_REGEX = re.compile(_URL_PATTERN)
+
+_VALID_NAME_REGEX = re.compile(r"[A-Za-z0-9_-]+")
+
 
 class GitHubIssuesMatcher:
+    """
+    Finds references to GitHub issues in chat messages.
+    Instances are meant to be reused, all patterns are compiled only once.
+    """
+
     def __init__(self, default_organization: str = None, default_repository: str = None, repository_aliases: dict = None):
         self._default_organization = default_organization
         self._default_repository = default_repository
-        self._repository_aliases = repository_aliases
+
+        if repository_aliases is None:
+            repository_aliases = {}
+
+        # aliases are not case-sensitive
+        self._repository_aliases = {k.lower(): v for k, v in repository_aliases.items()}
 
         self._logger = make_logger("GitHubIssuesResolver")
 
-    def find_github_issue_ids(self, data) -> List[GitHubIssue]:
-        # this regex will just match any string, even if embedded in some other string
-        # the idea is that when there's e.g., punctuation following an issue number, it will still trigger the
-        # integration
-        pattern = r"\s+([A-Za-z-_]+/)?([A-Za-z-_]+)?#([0-9]+)"
+    def _make_issue_from_short_reference(self, organization: str, repository: str, issue_id: str):
+        # the optional groups might match an empty string
+        # in that case, we just set the default values
+        if not organization:
+            organization = self._default_organization
 
-        # FIXME: workaround: the space in front of the data allows us to detect issues and PRs at the beginning of messages
-        # the space we require in the pattern prevents false-positive matches within random strings, e.g., URLs with query
-        # strings
-        data = " " + data
+        if not repository:
+            repository = self._default_repository
 
-        matches = re.findall(pattern, data)
-        self._logger.debug("GitHub issue/PR matches: %r", matches)
+        # substitute short aliases with the actual repo name, if such aliases are configured
+        repository = self._repository_aliases.get(repository.lower(), repository)
 
-        # figure out account and repo for all issues to allow for deduplicating them before resolving
-        issues: List[GitHubIssue] = []
+        if not _VALID_NAME_REGEX.fullmatch(organization) or not _VALID_NAME_REGEX.fullmatch(repository):
+            self._logger.warning("Invalid repository owner or name: %s/%s", organization, repository)
+            return None
 
-        for organization, repository, issue_id in matches:
-            # the regex might match an empty string, for some reason
-            # in that case, we just set the default values
-            if not organization:
-                organization = self._default_organization
+        return GitHubIssue(organization, repository, issue_id)
 
-            if not repository:
-                repository = self._default_repository
+    def find_all(self, data: str) -> List[GitHubIssue]:
+        """
+        Find both short references and URLs in a single pass. The issues are returned in the order they were
+        mentioned in.
+        """
 
-            # substitute short aliases with the actual repo name, if such aliases are configured
-            for short_name, real_name in self._repository_aliases.items():
-                if repository.lower() == short_name.lower():
-                    repository = real_name
-                    break
+        # cheap check to skip the vast majority of messages
+        if "#" not in data and "github.com" not in data:
+            return []
 
-            # our match might contain at least one slash, so we need to get rid of that
-            organization = organization.rstrip("/")
+        issues: List[GitHubIssue] = []
 
-            def is_valid_name(s: str):
-                for c in s:
-                    if c not in string.ascii_letters + string.digits + "-_":
-                        return False
-                return True
+        for match in _REFERENCES_REGEX.finditer(data):
+            organization, repository, issue_id, url_owner, url_repository, url_issue_id = match.groups()
 
-            if not is_valid_name(organization) or not is_valid_name(repository):
-                self._logger.warning("Invalid repository owner or name: %s/%s", organization, repository)
+            if url_issue_id is not None:
+                issues.append(GitHubIssue(url_owner, url_repository, url_issue_id))
                 continue
 
-            if not issue_id.isdigit():
-                self._logger.warning("Invalid issue ID: %s", issue_id)
-                continue
+            issue = self._make_issue_from_short_reference(organization, repository, issue_id)
 
-            issues.append(GitHubIssue(organization, repository, issue_id))
+            if issue is not None:
+                issues.append(issue)
 
-        return issues
+        self._logger.debug("GitHub issue/PR matches: %r", issues)
 
-    @staticmethod
-    def find_github_urls(data) -> List[GitHubIssue]:
-        matches = re.findall(r"(https://github.com/.+/.+/(?:issues|pull|discussions)/\d+[^\s#]+)", data)
+        return issues
 
+    def find_github_issue_ids(self, data) -> List[GitHubIssue]:
         issues: List[GitHubIssue] = []
 
-        for match in matches:
-            url = urllib.parse.urlparse(match)
-            if url.scheme != "https" or url.netloc != "github.com":
-                continue
+        for organization, repository, issue_id in _SHORT_REFERENCE_REGEX.findall(data):
+            issue = self._make_issue_from_short_reference(organization, repository, issue_id)
 
-            path_fragments = url.path.split("/")
-            if len(path_fragments) < 5:
-                continue
-
-            _, repo_owner, repo_name, _, issue_id = path_fragments[:5]
-            issues.append(GitHubIssue(repo_owner, repo_name, issue_id))
+            if issue is not None:
+                issues.append(issue)
 
         return issues
 
+    @staticmethod
+    def find_github_urls(data) -> List[GitHubIssue]:
+        return [GitHubIssue(*match) for match in _URL_REGEX.findall(data)]
+
     @staticmethod
     def deduplicate(issues: List[GitHubIssue]):
         issues_map: Dict[str, GitHubIssue] = {}
 
         for issue in issues:
-            issues_map[str(issue).lower()] = issue
+            issues_map[issue.unique_id] = issue
 
         return list(issues_map.values())
+
+
+if __name__ == "__main__":
+    # microbenchmark: python -m relbot.github_issues_matcher [chat log with one message per line]
+    import sys
+    import timeit
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            corpus = f.read().splitlines()
+
+    else:
+        corpus = [
+            "hey, did anyone look into #123 yet?",
+            "see https://github.com/blue-nebula/base/pull/42 and mr#7",
+            "nothing to see here, just some chatter",
+            "lol",
+            "other-org/other-repo#1337 is related to #12 #15 #19 #22",
+        ] * 200
+
+    matcher = GitHubIssuesMatcher("my-owner", "my-repo", {"mr": "my-repo"})
+
+    def run():
+        for message in corpus:
+            matcher.deduplicate(matcher.find_all(message))
+
+    iterations = 20
+    duration = timeit.timeit(run, number=iterations)
+    print("%d messages: %.2f µs per message" % (len(corpus), duration / iterations / len(corpus) * 1e6))
+
+    # scanning time must grow linearly with the length of the input
+    for size in [10000, 100000, 1000000]:
+        adversarial_inputs = [
+            "a" * size + "#",
+            "https://github.com/" + "a-" * (size // 2) + "#",
+            " a/" * (size // 3) + "#",
+        ]
+
+        for adversarial in adversarial_inputs:
+            duration = timeit.timeit(lambda: matcher.find_all(adversarial), number=1)
+            print("adversarial input, %d chars: %.2f ms" % (len(adversarial), duration * 1e3))
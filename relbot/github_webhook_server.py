@@ -0,0 +1,325 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+from typing import Awaitable, Callable, Dict, Tuple, Union
+from urllib.parse import parse_qs
+
+from relbot.github_events_api_client import GitHubEvent, UnsupportedEventError
+from relbot.util import make_logger
+
+
+class WebhookError(Exception):
+    """
+    Thrown whenever a webhook delivery cannot be accepted. Carries the HTTP status code to respond with.
+    """
+
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+    def __str__(self):
+        return "{} {}".format(self.status, self.reason)
+
+
+# webhook event names (X-GitHub-Event header) -> event types used by the events API
+WEBHOOK_EVENT_TYPES = {
+    "push": "PushEvent",
+    "pull_request": "PullRequestEvent",
+    "create": "CreateEvent",
+    "delete": "DeleteEvent",
+    "issues": "IssuesEvent",
+    "issue_comment": "IssueCommentEvent",
+    "release": "ReleaseEvent",
+}
+
+
+def make_signature(secret: bytes, body: bytes) -> str:
+    return "sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def verify_signature(secret: bytes, body: bytes, signature: Union[str, None]) -> bool:
+    """
+    Check the X-Hub-Signature-256 header of a delivery.
+    """
+
+    if not signature:
+        return False
+
+    # constant time comparison, so the signature cannot be guessed byte by byte
+    return hmac.compare_digest(make_signature(secret, body), signature)
+
+
+def event_from_webhook(webhook_event: str, data: dict) -> GitHubEvent:
+    """
+    Convert a webhook delivery into the same representation the events API client uses.
+    Webhook payloads are mostly a superset of the events API payloads, only the envelope differs.
+    """
+
+    try:
+        event_type = WEBHOOK_EVENT_TYPES[webhook_event]
+
+    except KeyError:
+        raise UnsupportedEventError(webhook_event)
+
+    payload = data
+
+    # the events API only reports published releases, webhooks also send drafts, edits, deletions etc.
+    if event_type == "ReleaseEvent" and data.get("action", None) != "published":
+        raise UnsupportedEventError(event_type, data.get("action", None))
+
+    # the events API only tells us the number of commits
+    if event_type == "PushEvent":
+        payload = {"size": len(data.get("commits", [])), "ref": data["ref"]}
+
+    return GitHubEvent.from_json(
+        {
+            # webhook deliveries are not part of the events API, so they do not have an event ID
+            "id": 0,
+            "type": event_type,
+            "actor": {"display_login": data["sender"]["login"]},
+            "repo": {"name": data["repository"]["full_name"]},
+            "created_at": "",
+            "payload": payload,
+        }
+    )
+
+
+class GitHubWebhookServer:
+    """
+    Minimal embedded HTTP server accepting GitHub webhook deliveries. Only authentic deliveries (i.e., ones with a
+    valid signature) are passed to the handler.
+    Meant to run behind a reverse proxy which terminates TLS, therefore it only speaks plain HTTP/1.1 and closes the
+    connection after every request.
+    The body has to be read before it can be authenticated, so the size of requests, the time clients may take to send
+    them and the number of concurrent connections are limited.
+    """
+
+    # the events we handle are well below this size, deliveries of huge pushes are rejected and left to the polling
+    MAX_BODY_SIZE = 1024 * 1024
+
+    # time a client has to send the entire request, including the body
+    REQUEST_TIMEOUT = 10
+
+    # further connections are rejected right away
+    MAX_CONNECTIONS = 16
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        secret: str,
+        handler: Callable[[GitHubEvent], Union[None, Awaitable[None]]],
+        path: str = "/",
+    ):
+        self.logger = make_logger(self.__class__.__name__)
+
+        self.host = host
+        self.port = port
+        self.path = path
+
+        self._secret = secret.encode()
+        self._handler = handler
+
+        self._server: Union[asyncio.AbstractServer, None] = None
+
+        # statistics
+        self.deliveries = 0
+        self.rejected = 0
+
+        # monotonic time of the last authentic delivery, allows users to tell whether webhooks are working
+        self.last_delivery_at: Union[float, None] = None
+        # the same per repository (full name in lower case) and event type (as used by the events API)
+        # webhooks may be configured to send only some event types, the others still need to be polled
+        self.last_delivery_at_by_repo_event: Dict[Tuple[str, str], float] = {}
+
+        self._connections = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.logger.info("listening for GitHub webhook deliveries on %s:%d%s", self.host, self.port, self.path)
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    @property
+    def sockets(self):
+        return self._server.sockets
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str], bytes]:
+        try:
+            request_line = await reader.readuntil(b"\r\n")
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+        except ValueError:
+            raise WebhookError(400, "Bad Request")
+
+        headers = {}
+
+        while True:
+            line = await reader.readuntil(b"\r\n")
+
+            if line == b"\r\n":
+                break
+
+            name, _, value = line.decode("latin-1").partition(":")
+
+            # header names are case-insensitive
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            content_length = int(headers.get("content-length", 0))
+
+        except ValueError:
+            raise WebhookError(400, "Bad Request")
+
+        if content_length < 0:
+            raise WebhookError(400, "Bad Request")
+
+        if content_length > self.MAX_BODY_SIZE:
+            raise WebhookError(413, "Payload Too Large")
+
+        # bounded by the request timeout
+        body = await reader.readexactly(content_length)
+
+        return method, path, headers, body
+
+    async def _handle_request(self, reader: asyncio.StreamReader) -> Tuple[int, str]:
+        method, path, headers, body = await asyncio.wait_for(self._read_request(reader), self.REQUEST_TIMEOUT)
+
+        if path.split("?", 1)[0] != self.path:
+            raise WebhookError(404, "Not Found")
+
+        if method != "POST":
+            raise WebhookError(405, "Method Not Allowed")
+
+        # we must not even look at the contents of deliveries we cannot authenticate
+        if not verify_signature(self._secret, body, headers.get("x-hub-signature-256", None)):
+            raise WebhookError(401, "Unauthorized")
+
+        self.last_delivery_at = time.monotonic()
+
+        webhook_event = headers.get("x-github-event", "")
+
+        # sent when the webhook is set up
+        if webhook_event == "ping":
+            return 200, "OK"
+
+        # webhooks can be configured to send either content type
+        try:
+            if headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+                data = json.loads(parse_qs(body.decode())["payload"][0])
+            else:
+                data = json.loads(body)
+
+        except (ValueError, KeyError):
+            raise WebhookError(400, "Bad Request")
+
+        try:
+            repo = data["repository"]["full_name"].lower()
+
+        # e.g., organization-wide events
+        except (KeyError, TypeError, AttributeError):
+            pass
+
+        else:
+            if webhook_event in WEBHOOK_EVENT_TYPES:
+                self.last_delivery_at_by_repo_event[(repo, WEBHOOK_EVENT_TYPES[webhook_event])] = self.last_delivery_at
+
+        try:
+            event = event_from_webhook(webhook_event, data)
+
+        # we just ignore all events we don't understand, GitHub doesn't need to know about that
+        except UnsupportedEventError as e:
+            self.logger.debug("%s", e)
+            return 202, "Accepted"
+
+        except (KeyError, TypeError):
+            self.logger.exception("failed to parse %s delivery %s", webhook_event, headers.get("x-github-delivery"))
+            raise WebhookError(400, "Bad Request")
+
+        result = self._handler(event)
+
+        if asyncio.iscoroutine(result):
+            await result
+
+        return 202, "Accepted"
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self._connections >= self.MAX_CONNECTIONS:
+            self.rejected += 1
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+
+        self._connections += 1
+
+        try:
+            try:
+                status, reason = await self._handle_request(reader)
+                self.deliveries += 1
+
+            except WebhookError as e:
+                self.logger.warning("rejected webhook delivery: %s", e)
+                self.rejected += 1
+                status, reason = e.status, e.reason
+
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                self.rejected += 1
+                return
+
+            except:  # noqa
+                self.logger.exception("unknown error while handling webhook delivery")
+                status, reason = 500, "Internal Server Error"
+
+            response = "HTTP/1.1 {} {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".format(status, reason)
+            writer.write(response.encode())
+            await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            self._connections -= 1
+            writer.close()
+
+
+if __name__ == "__main__":
+    # replay recorded webhook deliveries against a running server, e.g.:
+    # python -m relbot.github_webhook_server http://localhost:8080/ <secret> push push.json [pull_request pr.json ...]
+    # without any arguments, a local server is started which prints the events it receives
+    import sys
+    import uuid
+    import requests
+
+    if len(sys.argv) < 2:
+        server = GitHubWebhookServer("127.0.0.1", 8080, "secret", lambda e: print(e))
+
+        async def serve():
+            await server.start()
+            await asyncio.Event().wait()
+
+        asyncio.run(serve())
+        sys.exit(0)
+
+    url, secret_ = sys.argv[1], sys.argv[2].encode()
+
+    for webhook_event_, path_ in zip(sys.argv[3::2], sys.argv[4::2]):
+        with open(path_, "rb") as f:
+            body_ = f.read()
+
+        response_ = requests.post(
+            url,
+            data=body_,
+            headers={
+                "Content-Type": "application/json",
+                "X-GitHub-Event": webhook_event_,
+                "X-GitHub-Delivery": str(uuid.uuid4()),
+                "X-Hub-Signature-256": make_signature(secret_, body_),
+            },
+        )
+
+        print(path_, response_.status_code)
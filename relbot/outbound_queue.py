@@ -0,0 +1,227 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Deque, Dict, NamedTuple
+
+import irc3
+from irc3.plugins.command import Commands, command
+
+from relbot.util import make_logger
+
+
+class Priority(IntEnum):
+    """
+    Messages with lower values are sent first.
+    """
+
+    # replies to commands
+    INTERACTIVE = 0
+    # replies to regular chat messages, e.g., by the GitHub chat monitor
+    CHAT = 1
+    # notifications nobody asked for explicitly, e.g., the GitHub events feed
+    FEED = 2
+
+
+class OutboundMessage(NamedTuple):
+    command: str
+    target: str
+    message: str
+    enqueued_at: float
+
+
+class TokenBucket:
+    """
+    Allows bursts of up to capacity messages, and rate messages per second on average.
+    """
+
+    def __init__(self, capacity: int, rate: float):
+        self.capacity = capacity
+        self.rate = rate
+
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(self.capacity), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def try_consume(self) -> float:
+        """
+        Consume a token if one is available.
+        :return: 0 if a token has been consumed, otherwise the time in seconds until the next token is available
+        """
+
+        self._refill()
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+
+        return (1 - self._tokens) / self.rate
+
+
+@irc3.plugin
+class OutboundQueue:
+    """
+    Central queue for all messages the bot sends, including the replies of commands.
+    Limits the outgoing messages with a token bucket to prevent the server from kicking the bot for flooding. Messages
+    with a higher priority are sent first, and within the same priority, the targets take turns.
+    Only irc3's own error messages (e.g., on invalid command arguments) bypass the queue.
+    """
+
+    def __init__(self, bot):
+        self.logger = make_logger(self.__class__.__name__)
+
+        self.bot = bot
+
+        config = self.bot.config.get("outbound_queue", dict())
+
+        burst = int(config.get("burst", 4))
+        rate = float(config.get("rate", 0.5))
+
+        # flood control cannot be disabled, the server would kick the bot sooner or later
+        if burst < 1 or rate <= 0:
+            raise ValueError("invalid outbound_queue config: burst must be at least 1, rate must be positive")
+
+        self.bucket = TokenBucket(burst, rate)
+
+        # one queue per priority, which contains one queue per target
+        self._queues: Dict[Priority, Dict[str, Deque[OutboundMessage]]] = {p: OrderedDict() for p in Priority}
+        self._depth = 0
+
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+        # statistics
+        self.sent_count = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        # irc3 would send the replies of commands right away, the bucket must govern the entire connection
+        self.bot.get_plugin(Commands).command_callback = self._command_callback
+
+    def _command_callback(self, uid, to, messages):
+        """
+        Replacement for irc3's Commands.command_callback, which enqueues the replies instead of sending them.
+        """
+
+        if isinstance(messages, asyncio.Future):
+            messages = messages.result()
+
+        if messages is None:
+            return
+
+        if isinstance(messages, str):
+            messages = [messages]
+
+        for message in messages:
+            self.privmsg(to, message, Priority.INTERACTIVE)
+
+    def _enqueue(self, command_: str, target: str, message: str, priority: Priority):
+        if not message:
+            return
+
+        queue = self._queues[priority].setdefault(target, deque())
+        queue.append(OutboundMessage(command_, target, message, time.monotonic()))
+
+        self._depth += 1
+        self.max_depth = max(self.max_depth, self._depth)
+
+        self._wakeup.set()
+
+        if self._task is None or self._task.done():
+            self._task = self.bot.create_task(self._process())
+
+    def notice(self, target: str, message: str, priority: Priority = Priority.FEED):
+        self._enqueue("notice", target, message, priority)
+
+    def privmsg(self, target: str, message: str, priority: Priority = Priority.INTERACTIVE):
+        self._enqueue("privmsg", target, message, priority)
+
+    def reply(self, mask, target: str, message: str, priority: Priority = Priority.INTERACTIVE):
+        """
+        Reply to a command the same way irc3 does it, i.e., in private to private messages.
+        """
+
+        if target == self.bot.nick:
+            target = mask.nick
+
+        self.privmsg(target, message, priority)
+
+    def _pop(self) -> OutboundMessage:
+        for priority in Priority:
+            targets = self._queues[priority]
+
+            if not targets:
+                continue
+
+            # the target at the front of the queue sends one message, then moves to the back of the queue
+            target, queue = next(iter(targets.items()))
+            message = queue.popleft()
+
+            if queue:
+                targets.move_to_end(target)
+            else:
+                del targets[target]
+
+            self._depth -= 1
+
+            return message
+
+        raise IndexError("queue is empty")
+
+    async def _process(self):
+        while True:
+            if not self._depth:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # we must wait for a token before choosing the message, as more important messages might arrive meanwhile
+            delay = self.bucket.try_consume()
+
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            message = self._pop()
+
+            latency = time.monotonic() - message.enqueued_at
+            self.sent_count += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+            try:
+                # we do our own flood control, so the messages should not end up in irc3's queue
+                getattr(self.bot, message.command)(message.target, message.message, nowait=True)
+
+            except:  # noqa
+                self.logger.exception("failed to send %s to %s", message.command, message.target)
+
+    def depths(self) -> Dict[Priority, int]:
+        return {p: sum(len(q) for q in self._queues[p].values()) for p in Priority}
+
+    @command(name="outbound-stats", permission="admin", show_in_help_list=False)
+    def stats_command(self, mask, target, args):
+        """Show statistics of the outbound message queue
+
+            %%outbound-stats
+        """
+
+        depths = ", ".join("%s: %d" % (p.name.lower(), d) for p, d in self.depths().items())
+
+        if self.sent_count:
+            average_latency = self.total_latency / self.sent_count
+        else:
+            average_latency = 0.0
+
+        yield "queued: %s (max. %d), sent: %d, latency: %.2f s avg, %.2f s max" % (
+            depths,
+            self.max_depth,
+            self.sent_count,
+            average_latency,
+            self.max_latency,
+        )
@@ -0,0 +1,397 @@
+import asyncio
+import json
+import math
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Tuple, Union
+
+import irc3
+
+from relbot.redflare_client import Server, ServersAggregate
+from relbot.redflare_snapshot import RedflareSnapshotCache
+from relbot.util import atomic_write, make_logger
+
+
+class Summary(NamedTuple):
+    average: float
+    peak: float
+
+
+class Tier:
+    """
+    Fixed-size ring buffer of buckets, each covering resolution seconds. For every bucket, the average and the peak of
+    the samples are stored. Bucket n is stored in slot n % capacity, so old buckets are overwritten automatically.
+    """
+
+    def __init__(self, resolution: int, capacity: int):
+        self.resolution = resolution
+        self.capacity = capacity
+
+        # bucket numbers (time // resolution) stored in the slots, -1 marks empty slots
+        self.buckets = array("q", [-1]) * capacity
+        self.averages = array("f", [0.0]) * capacity
+        self.peaks = array("f", [0.0]) * capacity
+
+        # the current bucket, which is still being filled
+        self.open_bucket = -1
+        self.open_sum = 0.0
+        self.open_count = 0
+        self.open_peak = 0.0
+
+    def _close_open_bucket(self):
+        if self.open_count == 0:
+            return
+
+        slot = self.open_bucket % self.capacity
+
+        self.buckets[slot] = self.open_bucket
+        self.averages[slot] = self.open_sum / self.open_count
+        self.peaks[slot] = self.open_peak
+
+    def add(self, timestamp: float, value: float):
+        bucket = int(timestamp // self.resolution)
+
+        if bucket != self.open_bucket:
+            self._close_open_bucket()
+
+            self.open_bucket = bucket
+            self.open_sum, self.open_count, self.open_peak = 0.0, 0, value
+
+        self.open_sum += value
+        self.open_count += 1
+        self.open_peak = max(self.open_peak, value)
+
+    def summarize(self, now: float, duration: float) -> Union[Summary, None]:
+        """
+        Summarize all buckets which overlap with the given period. Costs at most duration / resolution steps.
+        :return: None if there are no samples within the period
+        """
+
+        last = int(now // self.resolution)
+        first = max(last - int(math.ceil(duration / self.resolution)) + 1, last - self.capacity + 1)
+
+        total, count, peak = 0.0, 0, -math.inf
+
+        for bucket in range(first, last + 1):
+            if bucket == self.open_bucket:
+                if self.open_count == 0:
+                    continue
+
+                average, bucket_peak = self.open_sum / self.open_count, self.open_peak
+
+            else:
+                slot = bucket % self.capacity
+
+                if self.buckets[slot] != bucket:
+                    continue
+
+                average, bucket_peak = self.averages[slot], self.peaks[slot]
+
+            total += average
+            count += 1
+            peak = max(peak, bucket_peak)
+
+        if count == 0:
+            return None
+
+        return Summary(total / count, peak)
+
+    def header(self) -> dict:
+        return {
+            "resolution": self.resolution,
+            "capacity": self.capacity,
+            "open": [self.open_bucket, self.open_sum, self.open_count, self.open_peak],
+        }
+
+    def arrays(self) -> List[array]:
+        return [self.buckets, self.averages, self.peaks]
+
+
+class TimeSeries:
+    """
+    Samples downsampled into multiple tiers of increasing resolution (e.g., minutes, hours and days). Every tier has a
+    fixed size, so the memory needed does not grow with the uptime.
+    """
+
+    def __init__(self, tiers: Iterable[Tuple[int, int]]):
+        """
+        :param tiers: (resolution in seconds, capacity) per tier, finest first
+        """
+
+        self.tiers = [Tier(resolution, capacity) for resolution, capacity in tiers]
+
+    def add(self, timestamp: float, value: float):
+        for tier in self.tiers:
+            tier.add(timestamp, value)
+
+    def summarize(self, now: float, duration: float) -> Union[Summary, None]:
+        # the coarsest tier which still has at least 24 buckets in the period needs the fewest steps
+        candidates = [t for t in self.tiers if t.resolution * t.capacity >= duration]
+
+        if not candidates:
+            raise ValueError("period too long: %d s" % duration)
+
+        fine_enough = [t for t in candidates if t.resolution <= duration / 24]
+
+        if fine_enough:
+            tier = fine_enough[-1]
+        else:
+            tier = candidates[0]
+
+        return tier.summarize(now, duration)
+
+    @property
+    def max_duration(self) -> float:
+        return max(t.resolution * t.capacity for t in self.tiers)
+
+
+# minutes for a day, hours for a month, days for two years
+TOTALS_TIERS = [(60, 24 * 60), (3600, 31 * 24), (86400, 2 * 365)]
+
+# per-server series are kept less detailed to save memory
+SERVER_TIERS = [(3600, 31 * 24), (86400, 2 * 365)]
+
+
+class PlayerCountHistory:
+    """
+    Player counts on legacy and 2.x servers, as well as on every single server (identified by hostname and port).
+    The number of servers which are tracked is limited, servers which have not been seen for the longest time are
+    forgotten first.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, max_servers: int = 64):
+        self.max_servers = max_servers
+
+        self.legacy = TimeSeries(TOTALS_TIERS)
+        self.non_legacy = TimeSeries(TOTALS_TIERS)
+
+        # "hostname:port" -> series
+        self.servers: Dict[str, TimeSeries] = OrderedDict()
+        # "hostname:port" -> description
+        self.descriptions: Dict[str, str] = {}
+
+    def add(self, timestamp: float, servers: List[Server], aggregate: ServersAggregate = None):
+        """
+        :param aggregate: totals of the given servers, if they have been calculated already (e.g., in a snapshot)
+        """
+
+        if aggregate is None:
+            aggregate = ServersAggregate.from_servers(servers)
+
+        self.legacy.add(timestamp, aggregate.legacy_players_count)
+        self.non_legacy.add(timestamp, aggregate.non_legacy_players_count)
+
+        keys = ["%s:%s" % (server.hostname, server.port) for server in servers]
+        current_keys = set(keys)
+
+        for key, server in zip(keys, servers):
+            try:
+                series = self.servers[key]
+                self.servers.move_to_end(key)
+
+            except KeyError:
+                if len(self.servers) >= self.max_servers:
+                    oldest_key = next(iter(self.servers))
+
+                    # all servers we track are still online, so there is no room for this one
+                    if oldest_key in current_keys:
+                        continue
+
+                    del self.servers[oldest_key]
+                    del self.descriptions[oldest_key]
+
+                series = self.servers[key] = TimeSeries(SERVER_TIERS)
+
+            # Redflare does not always know the player count
+            series.add(timestamp, server.players_count or 0)
+            self.descriptions[key] = server.description
+
+    def busiest_server(self, now: float, duration: float) -> Union[Tuple[str, Summary], None]:
+        """
+        :return: description and summary of the server with the highest average in the given period
+        """
+
+        best = None
+
+        for key, series in self.servers.items():
+            summary = series.summarize(now, duration)
+
+            if summary is None:
+                continue
+
+            if best is None or summary.average > best[1].average:
+                best = (self.descriptions[key], summary)
+
+        return best
+
+    def _all_series(self) -> List[Tuple[str, TimeSeries]]:
+        return [("legacy", self.legacy), ("non_legacy", self.non_legacy)] + [
+            ("server:" + key, series) for key, series in self.servers.items()
+        ]
+
+    def dumps(self) -> bytes:
+        """
+        Serialize the history: a JSON header line describing the series, followed by the raw contents of the arrays.
+        """
+
+        header = {
+            "version": self.FORMAT_VERSION,
+            "byteorder": sys.byteorder,
+            "descriptions": self.descriptions,
+            "series": [[name, [tier.header() for tier in series.tiers]] for name, series in self._all_series()],
+        }
+
+        parts = [json.dumps(header).encode(), b"\n"]
+
+        for _, series in self._all_series():
+            for tier in series.tiers:
+                parts += [a.tobytes() for a in tier.arrays()]
+
+        return b"".join(parts)
+
+    @classmethod
+    def loads(cls, data: bytes, max_servers: int = 64) -> "PlayerCountHistory":
+        header_data, _, body = data.partition(b"\n")
+        header = json.loads(header_data)
+
+        if header["version"] != cls.FORMAT_VERSION:
+            raise ValueError("unsupported format version: %r" % header["version"])
+
+        history = cls(max_servers)
+        history.descriptions = header["descriptions"]
+
+        offset = 0
+
+        for name, tier_headers in header["series"]:
+            series = TimeSeries((t["resolution"], t["capacity"]) for t in tier_headers)
+
+            for tier, tier_header in zip(series.tiers, tier_headers):
+                tier.open_bucket, tier.open_sum, tier.open_count, tier.open_peak = tier_header["open"]
+
+                for a in tier.arrays():
+                    size = a.itemsize * tier.capacity
+                    chunk = body[offset : offset + size]
+
+                    # e.g., the file has been truncated
+                    if len(chunk) != size:
+                        raise ValueError("unexpected end of data in series %s" % name)
+
+                    a[:] = array(a.typecode, chunk)
+                    offset += size
+
+                    if header["byteorder"] != sys.byteorder:
+                        a.byteswap()
+
+            if name == "legacy":
+                history.legacy = series
+            elif name == "non_legacy":
+                history.non_legacy = series
+            else:
+                history.servers[name[len("server:") :]] = series
+
+        if offset != len(body):
+            raise ValueError("%d unexpected bytes after the last series" % (len(body) - offset))
+
+        # make sure the descriptions match the series we know of
+        history.descriptions = {k: v for k, v in history.descriptions.items() if k in history.servers}
+
+        return history
+
+
+@irc3.plugin
+class PlayerCountHistoryPlugin:
+    """
+    Samples the player counts from the Redflare snapshot in the background, and persists the history periodically.
+    """
+
+    def __init__(self, bot):
+        self.logger = make_logger(self.__class__.__name__)
+
+        self.bot = bot
+        self.redflare: RedflareSnapshotCache = bot.get_plugin(RedflareSnapshotCache)
+
+        config = self.bot.config.get("relbot", dict())
+
+        self.path = config.get("redflare_history_file", "player_count_history.bin")
+        self.sample_interval = float(config.get("redflare_history_interval", 60))
+        self.save_interval = float(config.get("redflare_history_save_interval", 600))
+        self.max_servers = int(config.get("redflare_history_max_servers", 64))
+
+        self.history = self._load()
+
+        self._task: Union[asyncio.Task, None] = None
+
+    def _load(self) -> PlayerCountHistory:
+        try:
+            with open(self.path, "rb") as f:
+                return PlayerCountHistory.loads(f.read(), self.max_servers)
+
+        except FileNotFoundError:
+            self.logger.info("history file %s does not exist yet", self.path)
+
+        except (OSError, ValueError, KeyError):
+            self.logger.exception("failed to load history file %s, ignoring it", self.path)
+
+        return PlayerCountHistory(self.max_servers)
+
+    def save(self):
+        try:
+            atomic_write(self.path, self.history.dumps())
+
+        except OSError:
+            self.logger.exception("failed to save history file %s", self.path)
+
+    def sample(self):
+        snapshot = self.redflare.snapshot
+
+        # we'd rather have a gap in the history than record outdated data over and over again
+        if snapshot is None or snapshot.age > 2 * max(self.sample_interval, self.redflare.refresh_interval):
+            self.logger.debug("no recent snapshot, skipping sample")
+            return
+
+        self.history.add(time.time(), snapshot.servers, snapshot.aggregate)
+
+    async def sample_periodically(self):
+        last_saved = time.monotonic()
+
+        while True:
+            await asyncio.sleep(self.sample_interval)
+
+            try:
+                self.sample()
+
+                if time.monotonic() - last_saved >= self.save_interval:
+                    # writing a few hundred kilobytes is blocking, so it must not run in the event loop's thread
+                    await asyncio.to_thread(atomic_write, self.path, self.history.dumps())
+                    last_saved = time.monotonic()
+
+            except:  # noqa
+                self.logger.exception("unknown error while recording player counts")
+
+    @irc3.event(irc3.rfc.CONNECTED)
+    def start_sampling(self, **kwargs):
+        if not self.redflare.redflare_url or self.sample_interval <= 0:
+            return
+
+        # we might reconnect, but we only need to sample once
+        if self._task is not None and not self._task.done():
+            return
+
+        self._task = self.bot.create_task(self.sample_periodically())
+
+    @classmethod
+    def reload(cls, old):
+        # the new instance continues with what the old one has recorded so far
+        old.save()
+
+        new = cls(old.bot)
+
+        if old._task is not None and not old._task.done():
+            old._task.cancel()
+            new.start_sampling()
+
+        return new
@@ -1,74 +1,346 @@
-from typing import List, Union
+import asyncio
+from dataclasses import dataclass, fields
+from typing import Any, Dict, Iterable, List, Tuple, Union
 
-import requests
+from relbot.util import SingleFlight, managed_session
 
 
+# concurrent requests for the same server list share a single request
+_servers_single_flight = SingleFlight()
+
+
+@dataclass(slots=True)
 class Player:
-    def __init__(self):
-        self.color: Union[str, None] = None
-        self.privilege: Union[str, None] = None
-        self.team_color: Union[str, None] = None
-        self.name: Union[str, None] = None
-        self.account: Union[str, None] = None
+    color: Union[str, None] = None
+    privilege: Union[str, None] = None
+    team_color: Union[str, None] = None
+    name: Union[str, None] = None
+    account: Union[str, None] = None
+    # keys we don't know about, None if there are none
+    extra: Union[Dict[str, Any], None] = None
 
-    @staticmethod
-    def from_dict(data: dict) -> "Player":
-        player = Player()
+    @classmethod
+    def from_dict(cls, data: dict) -> "Player":
+        get = data.get
 
-        for k, v in data.items():
-            setattr(player, k, v)
+        player = cls(get("color"), get("privilege"), get("team_color"), get("name"), get("account"))
+
+        if not _PLAYER_KEYS.issuperset(data):
+            player.extra = {k: v for k, v in data.items() if k not in _PLAYER_KEYS}
 
         return player
 
 
+@dataclass(slots=True)
 class Server:
-    def __init__(self):
-        self.hostname: Union[str, None] = None
-        self.port: Union[int, None] = None
-        self.priority: Union[int, None] = None
-        self.flags: Union[List[str], None] = None
-        self.country: Union[str, None] = None
-        self.players_count: Union[int, None] = None
-        self.protocol: Union[str, None] = None
-        self.game_mode: Union[str, None] = None
-        self.mutators: Union[List[str], None] = None
-        self.max_slots: Union[int, None] = None
-        self.mastermode: Union[str, None] = None
-        self.modification_percentage: Union[int, None] = None
-        self.number_of_game_vars: Union[int, None] = None
-        self.version: Union[int, None] = None
-        self.version_platform: Union[int, None] = None
-        self.version_arch: Union[int, None] = None
-        self.game_state: Union[int, None] = None
-        self.time_left: Union[int, None] = None
-        self.map_name: Union[str, None] = None
-        self.map_screenshot: Union[str, None] = None
-        self.description: Union[str, None] = None
-        self.players: Union[List[Player], None] = None
-
-    @staticmethod
-    def from_dict(data: dict) -> "Server":
-        # replace players in dict with Player objects
-        data["players"] = [Player.from_dict(p) for p in data["players"]]
-
-        server = Server()
-
-        for k, v in data.items():
-            setattr(server, k, v)
+    hostname: Union[str, None] = None
+    port: Union[int, None] = None
+    priority: Union[int, None] = None
+    flags: Union[List[str], None] = None
+    country: Union[str, None] = None
+    players_count: Union[int, None] = None
+    protocol: Union[str, None] = None
+    game_mode: Union[str, None] = None
+    mutators: Union[List[str], None] = None
+    max_slots: Union[int, None] = None
+    mastermode: Union[str, None] = None
+    modification_percentage: Union[int, None] = None
+    number_of_game_vars: Union[int, None] = None
+    version: Union[str, None] = None
+    version_platform: Union[int, None] = None
+    version_arch: Union[int, None] = None
+    game_state: Union[int, None] = None
+    time_left: Union[int, None] = None
+    map_name: Union[str, None] = None
+    map_screenshot: Union[str, None] = None
+    description: Union[str, None] = None
+    players: Union[List[Player], None] = None
+    # keys we don't know about, None if there are none
+    extra: Union[Dict[str, Any], None] = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Server":
+        """
+        Decode a server from Redflare's JSON representation. Unlike setting the attributes one by one, this reads every
+        known key exactly once, and does not modify the dict.
+        """
+
+        get = data.get
+
+        players = get("players")
+
+        if players is not None:
+            players = [Player.from_dict(p) for p in players]
+
+        server = cls(
+            get("hostname"),
+            get("port"),
+            get("priority"),
+            get("flags"),
+            get("country"),
+            get("players_count"),
+            get("protocol"),
+            get("game_mode"),
+            get("mutators"),
+            get("max_slots"),
+            get("mastermode"),
+            get("modification_percentage"),
+            get("number_of_game_vars"),
+            get("version"),
+            get("version_platform"),
+            get("version_arch"),
+            get("game_state"),
+            get("time_left"),
+            get("map_name"),
+            get("map_screenshot"),
+            get("description"),
+            players,
+        )
+
+        if not _SERVER_KEYS.issuperset(data):
+            server.extra = {k: v for k, v in data.items() if k not in _SERVER_KEYS}
 
         return server
 
 
+# the keys the decoders know about, all other keys end up in the extra dicts
+_PLAYER_KEYS = frozenset(f.name for f in fields(Player)) - {"extra"}
+_SERVER_KEYS = frozenset(f.name for f in fields(Server)) - {"extra"}
+
+
+def is_legacy_server(server: Server) -> bool:
+    # servers which don't tell us their version are most likely old ones
+    return not (server.version or "").startswith("2.")
+
+
+def count_players(servers: Iterable[Server]) -> Tuple[int, int]:
+    """
+    :return: number of players on legacy servers, number of players on 2.x servers
+    """
+
+    legacy, non_legacy = 0, 0
+
+    for server in servers:
+        if is_legacy_server(server):
+            legacy += server.players_count or 0
+        else:
+            non_legacy += server.players_count or 0
+
+    return legacy, non_legacy
+
+
+class ServersAggregate:
+    """
+    Everything the commands need to know about a server list, collected in a single pass: the player counts on legacy
+    and 2.x servers, and the legacy servers on which matches are running.
+    """
+
+    __slots__ = ("legacy_players_count", "non_legacy_players_count", "busy_legacy_servers")
+
+    def __init__(self):
+        self.legacy_players_count = 0
+        self.non_legacy_players_count = 0
+        self.busy_legacy_servers: List[Server] = []
+
+    def add(self, server: Server):
+        players_count = server.players_count or 0
+
+        if is_legacy_server(server):
+            self.legacy_players_count += players_count
+
+            if players_count > 0:
+                self.busy_legacy_servers.append(server)
+
+        else:
+            self.non_legacy_players_count += players_count
+
+    @classmethod
+    def from_servers(cls, servers: Iterable[Server]) -> "ServersAggregate":
+        aggregate = cls()
+
+        for server in servers:
+            aggregate.add(server)
+
+        return aggregate
+
+
 class RedflareClient:
-    def __init__(self, redflare_url: str):
+    """
+    Instances remember the last server list, and revalidate it with conditional requests. Unless the list has
+    changed, Redflare just responds with a 304, and nothing needs to be decoded. Therefore, instances should be reused.
+    """
+
+    # (connect, read) timeouts in seconds
+    # a slow Redflare instance must not make the commands hang for too long
+    DEFAULT_TIMEOUT = (5, 15)
+
+    def __init__(self, redflare_url: str, timeout: Tuple[float, float] = DEFAULT_TIMEOUT):
         self._redflare_api_url = redflare_url + "/api/"
+        self.timeout = timeout
+
+        # last server list and its validators
+        self._servers: Union[List["Server"], None] = None
+        self._etag: Union[str, None] = None
+        self._last_modified: Union[str, None] = None
+
+    def servers(self) -> List["Server"]:
+        """
+        Fetch the server list. The request is blocking.
+        If the list has not changed since the last call, the same list object is returned.
+        """
 
-    def servers(self):
         url = self._redflare_api_url + "servers.json"
 
-        response = requests.get(url)
+        return _servers_single_flight.do(url, self._fetch_servers, url)
+
+    async def servers_async(self) -> List["Server"]:
+        # the request is blocking, so it must not run in the event loop's thread
+        return await asyncio.to_thread(self.servers)
+
+    def _fetch_servers(self, url: str) -> List["Server"]:
+        headers = {}
+
+        if self._servers is not None:
+            if self._etag:
+                headers["if-none-match"] = self._etag
+
+            if self._last_modified:
+                headers["if-modified-since"] = self._last_modified
+
+        # the shared session keeps the connections alive
+        # local Redflare instances are reached directly, all others through the proxy
+        with managed_session(url) as session:
+            response = session.get(url, headers=headers, timeout=self.timeout)
+
         response.raise_for_status()
 
+        if response.status_code == 304 and self._servers is not None:
+            return self._servers
+
         servers = response.json()["servers"]
 
-        return [Server.from_dict(s) for s in servers]
+        self._servers = [Server.from_dict(s) for s in servers]
+        self._etag = response.headers.get("etag", None)
+        self._last_modified = response.headers.get("last-modified", None)
+
+        return self._servers
+
+
+if __name__ == "__main__":
+    # benchmarks: python -m relbot.redflare_client [servers.json]
+    import copy
+    import json
+    import sys
+    import timeit
+    import tracemalloc
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            sample_servers = json.load(f)["servers"]
+
+    else:
+        sample_servers = [
+            {
+                "hostname": "192.0.2.%d" % (i % 256),
+                "port": 28801 + i,
+                "priority": 0,
+                "flags": [],
+                "country": "DE",
+                "players_count": i % 3,
+                "protocol": 226,
+                "game_mode": "deathmatch",
+                "mutators": ["ffa", "instagib"],
+                "max_slots": 16,
+                "mastermode": "open",
+                "modification_percentage": 0,
+                "number_of_game_vars": 0,
+                "version": "1.6.0",
+                "version_platform": 0,
+                "version_arch": 64,
+                "game_state": 0,
+                "time_left": 300,
+                "map_name": "bloodlust",
+                "map_screenshot": "",
+                "description": "server %d" % i,
+                "players": [
+                    {"color": "", "privilege": "", "team_color": "", "name": "player%d" % j, "account": ""}
+                    for j in range(i % 3)
+                ],
+            }
+            for i in range(100)
+        ]
+
+    class DictServer:
+        """
+        The previous representation, for comparison.
+        """
+
+        @staticmethod
+        def from_dict(data: dict):
+            data["players"] = [DictServer._player(p) for p in data["players"]]
+
+            server = DictServer()
+
+            for k, v in data.items():
+                setattr(server, k, v)
+
+            return server
+
+        @staticmethod
+        def _player(data: dict):
+            player = DictServer()
+
+            for k, v in data.items():
+                setattr(player, k, v)
+
+            return player
+
+    # scale the sample to 1,000 servers
+    thousand_servers = [sample_servers[i % len(sample_servers)] for i in range(1000)]
+
+    for name, decode in [("dict", DictServer.from_dict), ("slots", Server.from_dict)]:
+        # the previous decoder modifies its input
+        inputs = [[copy.deepcopy(s) for s in thousand_servers] for _ in range(20)]
+        it = iter(inputs)
+
+        duration = timeit.timeit(lambda: [decode(s) for s in next(it)], number=len(inputs)) / len(inputs)
+
+        data = [copy.deepcopy(s) for s in thousand_servers]
+
+        tracemalloc.start()
+        decoded = [decode(s) for s in data]
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print("%s: %.2f ms, %.0f KiB per 1,000 servers" % (name, duration * 1e3, memory / 1024))
+
+    # aggregating large server lists
+    def previous_rivalry(servers: List[Server]):
+        non_legacy_servers = [s for s in servers if s.version.startswith("2.")]
+        legacy_servers = [s for s in servers if not s in non_legacy_servers]
+
+        return sum([s.players_count for s in legacy_servers]), sum([s.players_count for s in non_legacy_servers])
+
+    for count in [1000, 10000, 50000]:
+        # a third are 2.x servers, and only a few servers are busy
+        servers_ = [
+            Server.from_dict(
+                dict(
+                    sample_servers[i % len(sample_servers)],
+                    version="2.0.0" if i % 3 == 0 else "1.6.0",
+                    players_count=i % 10 == 0 and 4 or 0,
+                )
+            )
+            for i in range(count)
+        ]
+
+        candidates = [("aggregate", ServersAggregate.from_servers)]
+
+        # the previous implementation is quadratic, it would take ages with larger lists
+        if count <= 1000:
+            candidates.insert(0, ("previous", previous_rivalry))
+
+        for name, func in candidates:
+            duration = timeit.timeit(lambda: func(servers_), number=3) / 3
+
+            print("%d servers, %s: %.2f ms" % (count, name, duration * 1e3))
@@ -0,0 +1,140 @@
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Tuple, Union
+
+from relbot.redflare_client import Server
+
+
+# transitions which can be announced
+MATCH_STARTED = "started"
+MATCH_ENDED = "ended"
+PLAYERS_JOINED = "joined"
+PLAYERS_LEFT = "left"
+MAP_CHANGED = "map"
+
+ALL_TRANSITIONS = (MATCH_STARTED, MATCH_ENDED, PLAYERS_JOINED, PLAYERS_LEFT, MAP_CHANGED)
+
+
+ServerKey = Tuple[str, int]
+
+
+class ServerState(NamedTuple):
+    """
+    The parts of a server's state we track. Everything else (e.g., the time left) changes all the time, and is not
+    interesting enough to be announced.
+    """
+
+    fingerprint: int
+    description: str
+    players: FrozenSet[str]
+    game_mode: str
+    map_name: str
+    mutators: Tuple[str, ...]
+
+    @staticmethod
+    def fingerprint_server(server: Server) -> int:
+        """
+        Cheap hash of the parts we track. Players changing places changes the fingerprint as well, but that only costs
+        a comparison which does not find any transitions.
+        """
+
+        players = tuple(p.name for p in server.players or ())
+        mutators = tuple(server.mutators or ())
+
+        return hash((players, server.description, server.game_mode, server.map_name, mutators))
+
+    @classmethod
+    def from_server(cls, server: Server, fingerprint: int) -> "ServerState":
+        players = frozenset(p.name for p in server.players or ())
+        mutators = tuple(server.mutators or ())
+
+        return cls(fingerprint, server.description, players, server.game_mode, server.map_name, mutators)
+
+
+class ServerTransition(NamedTuple):
+    kind: str
+    key: ServerKey
+    state: ServerState
+    # the players who joined or left, if any
+    players: FrozenSet[str]
+
+
+class RedflareDiff:
+    """
+    Computes what has changed between consecutive server lists. The servers are indexed by hostname and port.
+    Every server list is a complete new copy, so every server has to be visited. However, only a cheap fingerprint is
+    computed for each of them, unchanged servers (the vast majority) keep their previous state after a single
+    comparison of two integers. The states are only built and compared for the servers which have changed.
+    """
+
+    def __init__(self):
+        # None until the first server list has been seen, there is nothing to compare it to
+        self._index: Union[Dict[ServerKey, ServerState], None] = None
+
+    @staticmethod
+    def _diff_server(key: ServerKey, old: Union[ServerState, None], new: ServerState) -> List[ServerTransition]:
+        old_players = old.players if old is not None else frozenset()
+
+        if not old_players and new.players:
+            return [ServerTransition(MATCH_STARTED, key, new, new.players)]
+
+        if old_players and not new.players:
+            return [ServerTransition(MATCH_ENDED, key, new, old_players)]
+
+        transitions = []
+
+        # an empty server switching maps is nothing to talk about
+        if old is not None and new.players and (old.map_name, old.game_mode) != (new.map_name, new.game_mode):
+            transitions.append(ServerTransition(MAP_CHANGED, key, new, frozenset()))
+
+        joined = new.players - old_players
+        left = old_players - new.players
+
+        if joined:
+            transitions.append(ServerTransition(PLAYERS_JOINED, key, new, joined))
+
+        if left:
+            transitions.append(ServerTransition(PLAYERS_LEFT, key, new, left))
+
+        return transitions
+
+    def update(self, servers: Iterable[Server]) -> List[ServerTransition]:
+        """
+        Index a new server list, and return the transitions since the previous one.
+        """
+
+        old_index = self._index or {}
+
+        index: Dict[ServerKey, ServerState] = {}
+        changed: List[Tuple[ServerKey, Union[ServerState, None], ServerState]] = []
+
+        for server in servers:
+            key = (server.hostname, server.port)
+            fingerprint = ServerState.fingerprint_server(server)
+
+            old = old_index.get(key, None)
+
+            if old is not None and old.fingerprint == fingerprint:
+                index[key] = old
+                continue
+
+            index[key] = new = ServerState.from_server(server, fingerprint)
+            changed.append((key, old, new))
+
+        first_update = self._index is None
+        self._index = index
+
+        if first_update:
+            return []
+
+        transitions = []
+
+        for key, old, new in changed:
+            transitions += self._diff_server(key, old, new)
+
+        # servers which went offline while people were playing on them
+        for key in old_index.keys() - index.keys():
+            old = old_index[key]
+
+            if old.players:
+                transitions.append(ServerTransition(MATCH_ENDED, key, old, old.players))
+
+        return transitions
@@ -0,0 +1,184 @@
+import asyncio
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple, Union
+
+import irc3
+
+from relbot.redflare_client import RedflareClient, Server, ServersAggregate
+from relbot.util import make_logger
+
+
+class RedflareSnapshot(NamedTuple):
+    # incremented with every successful refresh
+    version: int
+    servers: List[Server]
+    # monotonic time
+    fetched_at: float
+    # collected in a single pass, so the commands don't need to walk the whole list
+    aggregate: ServersAggregate
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.fetched_at
+
+    def format_age(self) -> str:
+        age = int(self.age)
+
+        if age < 60:
+            return "as of %d s ago" % age
+
+        return "as of %d:%02d min ago" % (age // 60, age % 60)
+
+
+class RedflareUnavailableError(Exception):
+    """
+    Thrown whenever there is no snapshot at all, and Redflare cannot be reached.
+    """
+
+    pass
+
+
+@irc3.plugin
+class RedflareSnapshotCache:
+    """
+    Single snapshot of the Redflare server list, shared between all commands.
+    A background task refreshes the snapshot periodically, so commands can answer immediately. When the snapshot is
+    outdated (e.g., because Redflare is unreachable), the stale data is served while a refresh runs.
+    """
+
+    def __init__(self, bot):
+        self.logger = make_logger(self.__class__.__name__)
+
+        self.bot = bot
+
+        config = self.bot.config.get("relbot", dict())
+
+        self.redflare_url = config.get("redflare_url", None)
+        self.refresh_interval = float(config.get("redflare_refresh_interval", 60))
+
+        # the client is reused, so that unchanged server lists can be revalidated cheaply
+        self.client: Union[RedflareClient, None] = None
+
+        if self.redflare_url:
+            self.client = RedflareClient(self.redflare_url)
+
+        self.snapshot: Union[RedflareSnapshot, None] = None
+        self.last_error: Union[Exception, None] = None
+
+        self._refresh_task: Union[asyncio.Task, None] = None
+        self._refresh_periodically_task: Union[asyncio.Task, None] = None
+
+        # called whenever a new version of the snapshot is available
+        # name -> callback, so plugins can replace their callbacks when they are reloaded
+        self.listeners: Dict[str, Callable[[RedflareSnapshot], None]] = {}
+
+        # caches values derived from a snapshot, e.g., formatted messages
+        # key -> (snapshot version, value)
+        self._rendered: Dict[str, Tuple[int, Any]] = {}
+
+    async def _refresh(self) -> RedflareSnapshot:
+        try:
+            servers = await self.client.servers_async()
+
+        except Exception as e:
+            self.last_error = e
+            raise
+
+        self.last_error = None
+
+        # the client returns the very same list if nothing has changed, in which case nothing has to be rendered again
+        if self.snapshot is not None and servers is self.snapshot.servers:
+            self.snapshot = self.snapshot._replace(fetched_at=time.monotonic())
+            return self.snapshot
+
+        if self.snapshot is None:
+            version = 1
+        else:
+            version = self.snapshot.version + 1
+
+        self.snapshot = RedflareSnapshot(version, servers, time.monotonic(), ServersAggregate.from_servers(servers))
+
+        self.logger.debug("refreshed snapshot: version %d, %d servers", version, len(servers))
+
+        for name, listener in list(self.listeners.items()):
+            try:
+                listener(self.snapshot)
+
+            except:  # noqa
+                self.logger.exception("listener %s failed", name)
+
+        return self.snapshot
+
+    def refresh(self) -> asyncio.Task:
+        """
+        Start a refresh, unless one is running already.
+        """
+
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = self.bot.create_task(self._refresh())
+
+            # make sure errors are retrieved even if nobody waits for the task
+            self._refresh_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        return self._refresh_task
+
+    async def get(self) -> RedflareSnapshot:
+        """
+        Return the current snapshot immediately. Only if there is none yet, this waits for Redflare.
+        """
+
+        if self.snapshot is None:
+            try:
+                # the task is shared with other callers, so we must not cancel it when we are cancelled
+                return await asyncio.shield(self.refresh())
+
+            except Exception as e:
+                self.logger.error("failed to fetch servers from Redflare: %r", e)
+                raise RedflareUnavailableError()
+
+        # stale-while-revalidate
+        if self.snapshot.age > self.refresh_interval:
+            self.refresh()
+
+        return self.snapshot
+
+    def render(self, key: str, snapshot: RedflareSnapshot, func: Callable[[RedflareSnapshot], Any]) -> Any:
+        """
+        Derive a value from a snapshot only once per version of the snapshot.
+        """
+
+        try:
+            version, value = self._rendered[key]
+
+            if version == snapshot.version:
+                return value
+
+        except KeyError:
+            pass
+
+        value = func(snapshot)
+        self._rendered[key] = (snapshot.version, value)
+
+        return value
+
+    async def refresh_periodically(self):
+        while True:
+            try:
+                await asyncio.shield(self.refresh())
+
+            except Exception as e:
+                # the commands keep serving the previous snapshot
+                self.logger.warning("failed to refresh snapshot: %r", e)
+
+            await asyncio.sleep(self.refresh_interval)
+
+    @irc3.event(irc3.rfc.CONNECTED)
+    def start_refreshing(self, **kwargs):
+        if not self.redflare_url or self.refresh_interval <= 0:
+            return
+
+        # we might reconnect, but we only need to refresh once
+        if self._refresh_periodically_task is not None and not self._refresh_periodically_task.done():
+            return
+
+        self._refresh_periodically_task = self.bot.create_task(self.refresh_periodically())
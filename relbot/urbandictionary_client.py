@@ -1,10 +1,10 @@
 from collections import namedtuple
-from typing import Iterator
+from typing import Iterator, List
 from urllib.parse import urlencode
 
 from lxml import html
 
-from relbot.util import managed_proxied_session
+from relbot.util import managed_proxied_session, SingleFlight
 
 
 class UrbanDictionaryError(Exception):
@@ -14,6 +14,10 @@ class UrbanDictionaryError(Exception):
 UrbanDictionaryDefinition = namedtuple("UrbanDictionaryDefinition", ["word", "meaning", "example"])
 
 
+# concurrent lookups of the same term share a single request
+_define_single_flight = SingleFlight()
+
+
 class UrbanDictionaryClient:
     @staticmethod
     def build_url(term: str):
@@ -27,6 +31,10 @@ class UrbanDictionaryClient:
 
     @classmethod
     def define_all(cls, term: str) -> Iterator[UrbanDictionaryDefinition]:
+        yield from _define_single_flight.do(term, cls._define_all, term)
+
+    @classmethod
+    def _define_all(cls, term: str) -> List[UrbanDictionaryDefinition]:
         url = cls.build_url(term)
 
         with managed_proxied_session() as session:
@@ -40,20 +48,28 @@ class UrbanDictionaryClient:
 
         tree = html.fromstring(response.content)
 
-        definitions = tree.cssselect("#content .def-panel")
+        definitions = []
 
-        for definition in definitions:
+        for definition in tree.cssselect("#content .def-panel"):
             kwargs = {}
 
             for attribute in ["word", "meaning", "example"]:
                 attrib_elem = definition.cssselect(".{}".format(attribute))[0]
                 kwargs[attribute] = attrib_elem.text_content().replace("\n", " ")
 
-            yield UrbanDictionaryDefinition(**kwargs)
+            definitions.append(UrbanDictionaryDefinition(**kwargs))
+
+        return definitions
 
     @classmethod
-    def top_definition(cls, term: str):
-        return next(cls.define_all(term))
+    def top_definition(cls, term: str) -> UrbanDictionaryDefinition:
+        # a StopIteration must not escape, as it cannot be propagated through a future (e.g., from asyncio.to_thread)
+        definition = next(cls.define_all(term), None)
+
+        if definition is None:
+            raise UrbanDictionaryError("no definition found")
+
+        return definition
 
 
 if __name__ == "__main__":
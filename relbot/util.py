@@ -1,9 +1,20 @@
+import asyncio
 import contextlib
+import http.cookiejar
+import ipaddress
 import logging
 import os
+import queue
 import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Tuple
+from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import EmptyPoolError
 
 
 def format_github_event(event):
@@ -11,32 +22,367 @@ def format_github_event(event):
     return s
 
 
+class TimeoutSession(requests.Session):
+    """
+    Session which applies a default timeout to all requests which do not specify one explicitly.
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+class _BlockAllCookiesPolicy(http.cookiejar.DefaultCookiePolicy):
+    """
+    The session is shared by every caller, so it must not carry cookies from one request to another.
+    """
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+class BoundedHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter which waits at most pool_timeout seconds for a free connection when the pool of a host is exhausted.
+    urllib3 would wait forever, as requests never passes a pool timeout.
+    """
+
+    def __init__(self, pool_timeout: float, **kwargs):
+        # the connection pools' queues fall back to this timeout when urllib3 does not pass one
+        class _LifoQueue(queue.LifoQueue):
+            def get(self, block=True, timeout=None):
+                if timeout is None:
+                    timeout = pool_timeout
+
+                return super().get(block, timeout)
+
+        self._queue_cls = _LifoQueue
+
+        super().__init__(pool_block=True, **kwargs)
+
+    def _patch_pool_classes(self, manager):
+        manager.pool_classes_by_scheme = {
+            scheme: type(cls.__name__, (cls,), {"QueueCls": self._queue_cls})
+            for scheme, cls in manager.pool_classes_by_scheme.items()
+        }
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self._patch_pool_classes(self.poolmanager)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        new = proxy not in self.proxy_manager
+
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+
+        if new:
+            self._patch_pool_classes(manager)
+
+        return manager
+
+    def send(self, request, *args, **kwargs):
+        try:
+            return super().send(request, *args, **kwargs)
+
+        except EmptyPoolError as e:
+            # callers only expect requests' exceptions
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+
+class ProxiedSessionPool:
+    """
+    Process-wide, thread-safe pool of persistent HTTP(S) connections, tunneled through the local Tor proxy (unless
+    use_proxy is disabled). Keeping connections alive saves both the SOCKS handshake with the proxy and the TLS
+    handshake with the server for subsequent requests to the same host. Connections to hosts which have not been used
+    for a while are closed.
+    """
+
+    def __init__(
+        self,
+        max_connections_per_host: int = 4,
+        max_hosts: int = 16,
+        idle_timeout: float = 120,
+        timeout: Tuple[float, float] = (30, 60),
+        pool_timeout: float = 30,
+        use_proxy: bool = True,
+    ):
+        self.use_proxy = use_proxy
+        self.pool_timeout = pool_timeout
+        self.max_connections_per_host = max_connections_per_host
+        self.max_hosts = max_hosts
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._session = None
+
+        # hostname -> time the host has been used last
+        self._last_used: Dict[str, float] = {}
+
+        # connection statistics of pools which have been closed already
+        # hostname -> [connections, requests]
+        self._closed_stats: Dict[str, list] = {}
+
+    def _make_session(self) -> requests.Session:
+        session = TimeoutSession(self.timeout)
+        session.cookies.set_policy(_BlockAllCookiesPolicy())
+
+        if self.use_proxy:
+            tor_proxy_host = os.environ.get("TOR_PROXY_HOST", "127.0.0.1")
+
+            # local Tor proxy server
+            proxies = {
+                "http": f"socks5://{tor_proxy_host}:9050",
+                "https": f"socks5://{tor_proxy_host}:9050",
+            }
+
+            # this way, we only overwrite entries we want to change, and leave existing ones alone
+            session.proxies.update(proxies)
+
+        else:
+            # environment variables like HTTP_PROXY must not sneak a proxy in either
+            session.trust_env = False
+
+        # we never open more than the configured amount of connections to any host
+        # if all of them are busy for longer than pool_timeout (e.g., a slow host), the request fails
+        adapter = BoundedHTTPAdapter(
+            self.pool_timeout, pool_connections=self.max_hosts, pool_maxsize=self.max_connections_per_host
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+        session.hooks["response"].append(self._on_response)
+
+        return session
+
+    def _on_response(self, response, *args, **kwargs):
+        hostname = urlparse(response.url).hostname
+
+        with self._lock:
+            self._last_used[hostname] = time.monotonic()
+
+    def _connection_pools(self):
+        """
+        Iterate over all urllib3 connection pools (one per host) the session currently holds.
+        """
+
+        if self._session is None:
+            return
+
+        # the same adapter is mounted for both schemes
+        for adapter in set(self._session.adapters.values()):
+            for manager in [adapter.poolmanager, *adapter.proxy_manager.values()]:
+                for key in list(manager.pools.keys()):
+                    pool = manager.pools.get(key)
+
+                    if pool is not None:
+                        yield manager, key, pool
+
+    def _evict_idle_hosts(self):
+        now = time.monotonic()
+
+        idle_hosts = {host for host, last_used in self._last_used.items() if now - last_used > self.idle_timeout}
+
+        if not idle_hosts:
+            return
+
+        for manager, key, pool in list(self._connection_pools()):
+            if pool.host in idle_hosts:
+                stats = self._closed_stats.setdefault(pool.host, [0, 0])
+                stats[0] += pool.num_connections
+                stats[1] += pool.num_requests
+
+                # removing the pool from the container closes it
+                manager.pools.pop(key, None)
+
+        for host in idle_hosts:
+            del self._last_used[host]
+
+    def get(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = self._make_session()
+
+            self._evict_idle_hosts()
+
+            return self._session
+
+    def stats(self) -> Dict[str, Tuple[int, int]]:
+        """
+        :return: hostname -> (new connections, reused connections)
+        """
+
+        with self._lock:
+            stats = {host: list(values) for host, values in self._closed_stats.items()}
+
+            for _, _, pool in self._connection_pools():
+                values = stats.setdefault(pool.host, [0, 0])
+                values[0] += pool.num_connections
+                values[1] += pool.num_requests
+
+        return {
+            host: (connections, max(0, requests_ - connections)) for host, (connections, requests_) in stats.items()
+        }
+
+
+_proxied_session_pool = ProxiedSessionPool()
+
+# the Tor proxy cannot reach services on the bot's own host
+_direct_session_pool = ProxiedSessionPool(use_proxy=False)
+
+
 @contextlib.contextmanager
 def managed_proxied_session():
     """
-    Set up requests session with proxies preconfigured. HTTP(S) requests done via this session object should be proxied
+    Provide requests session with proxies preconfigured. HTTP(S) requests done via this session object should be proxied
     automatically.
+    The session is shared by the entire process, and keeps connections alive between requests. Therefore, it must not
+    be modified or closed by the caller.
     :return: session with proxies preconfigured
     """
 
-    tor_proxy_host = os.environ.get("TOR_PROXY_HOST", "127.0.0.1")
+    yield _proxied_session_pool.get()
+
+
+def is_loopback_url(url: str) -> bool:
+    hostname = urlparse(url).hostname
+
+    if hostname == "localhost":
+        return True
+
+    try:
+        return ipaddress.ip_address(hostname).is_loopback
+
+    except ValueError:
+        return False
+
+
+@contextlib.contextmanager
+def managed_session(url: str):
+    """
+    Like managed_proxied_session, but loopback URLs (e.g., local test servers) are connected to directly.
+    :param url: URL (or base URL) the session will be used for
+    """
+
+    if is_loopback_url(url):
+        yield _direct_session_pool.get()
+
+    else:
+        yield _proxied_session_pool.get()
+
+
+def proxied_session_pool_stats() -> Dict[str, Tuple[int, int]]:
+    return _proxied_session_pool.stats()
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls: while a call for some key is running in one thread, other threads calling
+    with the same key wait for it to finish, and share its result (or its error) instead of doing the work again.
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, "SingleFlight._Call"] = {}
+
+    def do(self, key: Hashable, func: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            call = self._calls.get(key, None)
+            leader = call is None
+
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+
+            if call.error is not None:
+                raise call.error
+
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+
+        except BaseException as e:
+            call.error = e
+            raise
+
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """
+    Coroutine-based equivalent of SingleFlight. Must only be used from within the event loop's thread.
+    """
+
+    def __init__(self):
+        self._futures: Dict[Hashable, asyncio.Future] = {}
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._futures
+
+    def do(self, key: Hashable, coroutine_function: Callable, *args, **kwargs) -> asyncio.Future:
+        """
+        Schedule the call unless an identical one is running already. The call is registered right away, so any
+        subsequent call with the same key will be coalesced, even before the first one has started running.
+        :return: future all callers with the same key share
+        """
+
+        future = self._futures.get(key, None)
+
+        if future is None:
+            future = asyncio.ensure_future(coroutine_function(*args, **kwargs))
+            self._futures[key] = future
+
+            def remove(_):
+                if self._futures.get(key, None) is future:
+                    del self._futures[key]
 
-    # local Tor proxy server
-    proxies = {
-        "http": f"socks5://{tor_proxy_host}:9050",
-        "https": f"socks5://{tor_proxy_host}:9050",
-    }
+            future.add_done_callback(remove)
 
-    session = requests.session()
+        # the shield prevents callers from cancelling the call for everyone else
+        return asyncio.shield(future)
 
-    # this way, we only overwrite entries we want to change, and leave existing ones alone
-    session.proxies.update(proxies)
+
+def atomic_write(path: str, data: bytes):
+    """
+    Replace a file atomically, so it never ends up half-written (e.g., if the bot is killed while writing).
+    """
+
+    directory = os.path.dirname(os.path.abspath(path))
+
+    # the temporary file must be on the same file system for the rename to be atomic
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
 
     try:
-        yield session
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        os.replace(temp_path, path)
+
+    except OSError:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
 
-    finally:
-        session.close()
+        raise
 
 
 def make_logger(name: str):
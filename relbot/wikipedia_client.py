@@ -1,10 +1,10 @@
 from collections import namedtuple
-from typing import Iterator
+from typing import Iterator, List
 from urllib.parse import urlencode, quote
 
 from bs4 import BeautifulSoup
 
-from relbot.util import managed_proxied_session
+from relbot.util import managed_proxied_session, SingleFlight
 
 
 WikipediaPage = namedtuple("WikipediaPage", ["title", "snippet"])
@@ -14,6 +14,10 @@ class WikipediaAPIError(Exception):
     pass
 
 
+# concurrent searches for the same term share a single request
+_search_single_flight = SingleFlight()
+
+
 class WikipediaAPIClient:
     @staticmethod
     def build_search_api_url(term: str):
@@ -36,6 +40,10 @@ class WikipediaAPIClient:
 
     @classmethod
     def search_for_term(cls, term: str) -> Iterator[WikipediaPage]:
+        yield from _search_single_flight.do(term, cls._search_for_term, term)
+
+    @classmethod
+    def _search_for_term(cls, term: str) -> List[WikipediaPage]:
         url = cls.build_search_api_url(term)
 
         with managed_proxied_session() as session:
@@ -51,12 +59,16 @@ class WikipediaAPIClient:
         if error:
             raise WikipediaAPIError("API error: %s: %s" % (error["code"], error["info"]))
 
+        pages = []
+
         for result in data["query"]["search"]:
             title = result["title"]
 
             snippet = BeautifulSoup(result["snippet"], "lxml").get_text()
 
-            yield WikipediaPage(title, snippet)
+            pages.append(WikipediaPage(title, snippet))
+
+        return pages
 
 
 if __name__ == "__main__":
@@ -0,0 +1,138 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from relbot.github_chat_monitor import GitHubChatMonitorPlugin
+from relbot.github_issue_resolver import (
+    GitHubIssueResolverBackend,
+    GitHubIssueResolverError,
+    GitHubIssueScraper,
+    GitHubRESTBackend,
+    ResolvedGitHubIssue,
+    make_backend,
+)
+from relbot.github_issues_matcher import GitHubIssue
+
+
+class FakeBot:
+    def __init__(self, config: dict):
+        self.config = {"github_chat_monitor": config}
+        self.plugins = {}
+
+    def get_plugin(self, cls):
+        return self.plugins.setdefault(cls, cls(self))
+
+
+class FakeBackend(GitHubIssueResolverBackend):
+    def __init__(self, results=None, error=None):
+        super().__init__()
+
+        self.results = results or {}
+        self.error = error
+        self.calls = []
+
+    def resolve_many(self, issues):
+        self.calls.append(issues)
+
+        if self.error is not None:
+            raise self.error
+
+        return {issue.unique_id: self.results[issue.unique_id] for issue in issues if issue.unique_id in self.results}
+
+
+ISSUE = GitHubIssue("blue-nebula", "base", 123)
+RESOLVED = ResolvedGitHubIssue(ISSUE, "Issue", "Some issue", "https://github.com/blue-nebula/base/issues/123")
+
+
+def make_plugin(**config) -> GitHubChatMonitorPlugin:
+    return GitHubChatMonitorPlugin(FakeBot(config))
+
+
+def lookup(plugin: GitHubChatMonitorPlugin, issue: GitHubIssue) -> ResolvedGitHubIssue:
+    async def run():
+        return await plugin.lookup_issue(issue, None, asyncio.Semaphore(1))
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("name", ["scraper", "rest", "graphql"])
+def test_make_backend(name):
+    scraper = GitHubIssueScraper()
+    backend = make_backend(name, scraper=scraper)
+
+    assert (backend is scraper) == (name == "scraper")
+
+
+def test_scraper_backend_is_the_fallback():
+    plugin = make_plugin()
+
+    assert plugin.backend is plugin.scraper
+
+
+def test_failing_scraper_is_not_retried():
+    plugin = make_plugin()
+    plugin.backend = plugin.scraper = FakeBackend(error=GitHubIssueResolverError("HTTP status 502"))
+
+    with pytest.raises(GitHubIssueResolverError):
+        lookup(plugin, ISSUE)
+
+    assert len(plugin.scraper.calls) == 1
+
+
+@pytest.mark.parametrize("backend", [FakeBackend(error=GitHubIssueResolverError("HTTP status 502")), FakeBackend()])
+def test_fallback_to_scraper(backend):
+    plugin = make_plugin(backend="rest")
+    plugin.backend = backend
+    plugin.scraper = FakeBackend({ISSUE.unique_id: RESOLVED})
+
+    assert lookup(plugin, ISSUE) == RESOLVED
+    assert len(backend.calls) == 1
+    assert len(plugin.scraper.calls) == 1
+
+
+def test_no_fallback_if_backend_resolves_issue():
+    plugin = make_plugin(backend="rest")
+    plugin.backend = FakeBackend({ISSUE.unique_id: RESOLVED})
+    plugin.scraper = FakeBackend()
+
+    assert lookup(plugin, ISSUE) == RESOLVED
+    assert plugin.scraper.calls == []
+
+
+class StandInAPIHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/repos/blue-nebula/base/issues/123":
+            self.send_error(404)
+            return
+
+        body = json.dumps({"title": "Some issue ", "html_url": RESOLVED.url}).encode()
+
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInAPIHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_rest_backend_with_stand_in_api(stand_in_api):
+    backend = GitHubRESTBackend(stand_in_api)
+
+    assert backend.resolve_many([ISSUE]) == {ISSUE.unique_id: RESOLVED}
+    assert backend.resolve_many([GitHubIssue("blue-nebula", "base", 1)]) == {}
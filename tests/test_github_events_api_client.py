@@ -0,0 +1,241 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import pytest
+import requests
+
+from relbot.github_events_api_client import CachedEventsPage, GithubEventsAPIClient, align_poll_time
+
+
+def make_client(remaining: int, time_until_reset: float, idle_polls: int = 0) -> GithubEventsAPIClient:
+    client = GithubEventsAPIClient("blue-nebula")
+
+    client.rate_limit_remaining = remaining
+    client.rate_limit_reset = int(time.time() + time_until_reset)
+    client.idle_polls = idle_polls
+
+    return client
+
+
+def test_next_poll_delay_uses_poll_interval():
+    assert make_client(5000, 3600).next_poll_delay() == GithubEventsAPIClient.DEFAULT_POLL_INTERVAL
+
+
+def test_next_poll_delay_backs_off_while_idle():
+    assert make_client(5000, 3600, idle_polls=2).next_poll_delay() == 4 * GithubEventsAPIClient.DEFAULT_POLL_INTERVAL
+    assert make_client(5000, 3600, idle_polls=16).next_poll_delay() == 600
+
+
+def test_next_poll_delay_shares_rate_limit_between_clients():
+    client = make_client(10, 1000)
+
+    assert client.next_poll_delay() == pytest.approx(100, abs=1)
+    assert client.next_poll_delay(active_clients=4) == pytest.approx(400, abs=4)
+
+
+def test_next_poll_delay_waits_for_reset():
+    assert make_client(0, 1800).next_poll_delay(active_clients=4) == pytest.approx(1800, abs=1)
+
+
+def test_align_poll_time():
+    assert align_poll_time(100, 15, 60) == 135
+    assert align_poll_time(135, 15, 60) == 135
+    # rounding errors must not postpone a poll by an entire period
+    assert align_poll_time(135 + 1e-9, 15, 60) == 135
+
+
+def test_polls_stay_staggered():
+    # whatever delays the clients use, they only ever poll in their own phase
+    phases = [0, 20, 40]
+    delays = [60, 73.5, 600]
+
+    for phase, delay in zip(phases, delays):
+        scheduled_at = align_poll_time(1000, phase, 60)
+
+        for _ in range(10):
+            assert scheduled_at % 60 == pytest.approx(phase)
+            scheduled_at = align_poll_time(scheduled_at + delay, phase, 60)
+
+
+class StandInEventsAPI:
+    """
+    Serves the events of any number of organizations. Every organization has a single event initially, more can be
+    added while the server is running.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.requests = 0
+        self.not_modified = 0
+
+        # status code and headers of an error response to send instead of the events, e.g., to simulate rate limits
+        self.error = None
+
+        self._lock = threading.Lock()
+
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                org = urlparse(self.path).path.split("/")[2]
+
+                with api._lock:
+                    api.requests += 1
+
+                    if api.error is not None:
+                        status, headers = api.error
+                        self.send_response(status)
+
+                        for name, value in headers.items():
+                            self.send_header(name, value)
+
+                        self.send_header("content-length", "0")
+                        self.end_headers()
+                        return
+
+                    events = api.events.setdefault(org, [api.make_event(org, 1)])
+                    etag = '"%s"' % events[0]["id"]
+
+                    if self.headers.get("if-none-match", None) == etag:
+                        api.not_modified += 1
+                        self.send_response(304)
+                        self.send_header("etag", etag)
+                        self.end_headers()
+                        return
+
+                    body = json.dumps(events).encode()
+
+                self.send_response(200)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.send_header("etag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+    @staticmethod
+    def make_event(org: str, event_id: int) -> dict:
+        return {
+            "id": str(event_id),
+            "type": "PushEvent",
+            "actor": {"display_login": "someone"},
+            "repo": {"name": "%s/base" % org},
+            "created_at": "2024-01-01T00:00:00Z",
+            "payload": {"size": 1, "ref": "refs/heads/master"},
+        }
+
+    def add_event(self, org: str):
+        with self._lock:
+            events = self.events[org]
+            events.insert(0, self.make_event(org, int(events[0]["id"]) + 1))
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:%d" % self.server.server_address[1]
+
+
+@pytest.fixture
+def stand_in_api():
+    api = StandInEventsAPI()
+    threading.Thread(target=api.server.serve_forever, daemon=True).start()
+
+    yield api
+
+    api.server.shutdown()
+    api.server.server_close()
+
+
+def run_sources(api: StandInEventsAPI, count: int) -> int:
+    """
+    Set up count sources, poll all of them twice, with a new event for every other source in between.
+    :return: the number of requests needed
+    """
+
+    requests_before = api.requests
+
+    orgs = ["org%d-%d" % (count, i) for i in range(count)]
+    clients = [GithubEventsAPIClient(org, api_url=api.url) for org in orgs]
+
+    for client in clients:
+        client.setup()
+
+    for org in orgs[::2]:
+        api.add_event(org)
+
+    for _ in range(2):
+        new_events = [list(client.fetch_new_events()) for client in clients]
+
+        for client, events in zip(clients, new_events):
+            # every source keeps its own checkpoint
+            assert client.last_reported_id == len(api.events[client.source])
+
+        # the events are only reported once
+        api_events = [[e.id for e in events] for events in new_events]
+        assert sum(map(len, api_events)) in (0, len(orgs[::2]))
+
+    return api.requests - requests_before
+
+
+def test_many_sources_with_stand_in_api(stand_in_api):
+    requests_100 = run_sources(stand_in_api, 100)
+    requests_300 = run_sources(stand_in_api, 300)
+
+    # one request per source and poll, nothing else
+    assert requests_100 == 3 * 100
+    assert requests_300 == 3 * 300
+
+    # unchanged sources are revalidated with conditional requests
+    assert stand_in_api.not_modified == (100 + 300) // 2 + (100 + 300)
+
+
+def test_rate_limited_responses_are_honored(stand_in_api):
+    client = GithubEventsAPIClient("rate-limited", api_url=stand_in_api.url)
+    client.setup()
+
+    reset = int(time.time() + 3600)
+    stand_in_api.error = (403, {"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": str(reset)})
+
+    with pytest.raises(requests.HTTPError):
+        list(client.fetch_new_events())
+
+    # the headers are parsed even though the request failed
+    assert client.rate_limit_remaining == 0
+    assert client.next_poll_delay() == pytest.approx(3600, abs=2)
+
+    # secondary rate limits only tell us how long to wait
+    client.rate_limit_remaining, client.rate_limit_reset = None, None
+    stand_in_api.error = (429, {"Retry-After": "120"})
+
+    with pytest.raises(requests.HTTPError):
+        list(client.fetch_new_events())
+
+    assert client.next_poll_delay() == pytest.approx(120, abs=2)
+
+
+def test_shifted_pages_are_not_reported_twice():
+    client = GithubEventsAPIClient("blue-nebula")
+    client.last_reported_id = 1
+
+    def make_page(ids):
+        return tuple(StandInEventsAPI.make_event("blue-nebula", i) for i in ids)
+
+    # two new events arrived after the first page had been fetched, so 6 and 5 show up again on the second page
+    first_page = CachedEventsPage(None, None, 8, 5, make_page([8, 7, 6, 5]), "next")
+    client._fetch_first_page = lambda: first_page
+    client._fetch_page = lambda url: (list(make_page([6, 5, 4, 3])), None) if url == "next" else ([], None)
+
+    assert [e.id for e in client.fetch_new_events()] == [8, 7, 6, 5, 4, 3]
+    assert client.last_reported_id == 8
+
+    # the reported entries are not kept in the cache
+    assert first_page.entries == ()